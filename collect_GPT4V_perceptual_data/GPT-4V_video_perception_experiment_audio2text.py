@@ -15,105 +15,156 @@ Last modified: 15/5/2024
 
 import os
 import time
-from openai import OpenAI
-
-client = OpenAI()
+from audio_screening import HALLUCINATION_PHRASES, is_hallucination, mark_files
+from clip_manifest import build_manifest, clip_files, save_manifest, update_clip
+from rate_limiter import RateLimitScheduler
+from transcription_backends import make_backend, transcribe_files
+
+def process_audio_files(folder_path, processed_file='audio_processed.txt', backend=None, workers=None,
+                        min_speech_ratio=0.05, start_phrases=HALLUCINATION_PHRASES, max_no_speech=0.6,
+                        marked_file='marked_files_index.txt', manifest=None):
+    """ Transcribe the mp3 of every subfolder not processed yet, on a pool of workers.
+
+    Clips without speech (min_speech_ratio, None to send everything) are not
+    transcribed; hallucinated transcripts are added to marked_file as they come in.
+    """
+    start_time = time.time()
 
-def transcribe_audio(file_path):
-    """ Transcribe audio using Whisper and save the transcription to a text file. """
-    with open(file_path, "rb") as audio_file:
-        transcript = client.audio.transcriptions.create(
-            model="whisper-1", 
-            file=audio_file,
-            response_format="text"
-        )
-    return transcript
+    if backend is None:
+        backend = make_backend('openai')
 
-def process_audio_files(folder_path, processed_file='audio_processed.txt'):
-    start_time = time.time()
+    # Clips and their audio from one scan of the folder
+    if manifest is None:
+        manifest = build_manifest(folder_path)
     
     try:
         with open(processed_file, 'r') as f:
-            processed_files = [line.strip() for line in f]
+            processed_files = set(line.strip() for line in f)
     except FileNotFoundError:
-        processed_files = []
+        processed_files = set()
+
+    # mp3 files still to transcribe, per subfolder
+    pending = {}
+    for subfolder in manifest['clips']:
+        if subfolder not in processed_files:
+            mp3_files = clip_files(manifest, subfolder, 'audio')
+            if mp3_files:
+                pending[subfolder] = mp3_files
+    subfolders = {file_path: subfolder for subfolder, mp3_files in pending.items() for file_path in mp3_files}
+    remaining = {subfolder: len(mp3_files) for subfolder, mp3_files in pending.items()}
+    print(f"{len(subfolders)} files in {len(pending)} folders to transcribe.")
 
     processed_count = 0
-    for subfolder in os.listdir(folder_path):
-        subfolder_path = os.path.join(folder_path, subfolder)
-        if os.path.isdir(subfolder_path) and subfolder not in processed_files:            
-            for filename in os.listdir(subfolder_path):
-                file_path = os.path.join(subfolder_path, filename)
-                
-                if filename.lower().endswith('.mp3'):
-                    transcript_text = transcribe_audio(file_path)          
-                    
-                    # Save transcription as a text file in the same folder
-                    text_file_path = file_path.replace('.mp3', '.txt')  # Change the file extension to .txt
-                    with open(text_file_path, 'w', encoding='utf-8') as text_file:
-                        text_file.write(transcript_text)
-                    
-                    # Save progress
-                    with open(processed_file, 'a', encoding='utf-8') as f:
-                        f.write(subfolder + '\n')
-                    
-                    processed_count += 1  # Increment processed count
-                    print(f"Transcribed and saved: {file_path}")
+    skipped_count = 0
+    failed = []
+    for file_path, result, error in transcribe_files(list(subfolders), backend, workers, min_speech_ratio):
+        subfolder = subfolders[file_path]
+        if error is not None:
+            failed.append(file_path)
+            remaining[subfolder] = None  # the folder is tried again on the next run
+            print(f"Failed to transcribe {file_path}: {error}")
+            continue
+
+        if result['text'] is None:
+            # No speech found, nothing to transcribe
+            skipped_count += 1
+            print(f"No speech in {file_path} (speech ratio {result['speech_ratio']:.2f}), skipped.")
+        else:
+            # Save transcription as a text file in the same folder
+            text_file_path = file_path[:-4] + '.txt'  # Change the file extension to .txt
+            with open(text_file_path, 'w', encoding='utf-8') as text_file:
+                text_file.write(result['text'])
+            update_clip(manifest, subfolder)
+            processed_count += 1  # Increment processed count
+            print(f"Transcribed and saved: {file_path} ({processed_count + skipped_count}/{len(subfolders)})")
+
+            hallucination, reason = is_hallucination(result['text'], result['no_speech_prob'],
+                                                     start_phrases, max_no_speech)
+            if hallucination:
+                mark_files([text_file_path[:-4]], marked_file)
+                print(f"Marked {text_file_path}: {reason}")
+
+        # Save progress once all the files of the folder are done
+        if remaining[subfolder] is not None:
+            remaining[subfolder] -= 1
+            if remaining[subfolder] == 0:
+                with open(processed_file, 'a', encoding='utf-8') as f:
+                    f.write(subfolder + '\n')
                 
+    # Add the new transcripts to the manifest
+    save_manifest(manifest)
+
     total_time = time.time() - start_time
-    print(f"Processed {processed_count} files, total elapsed time: {total_time:.2f} ses.")
+    print(f"Processed {processed_count} files, {skipped_count} without speech skipped, {len(failed)} failed, "
+          f"total elapsed time: {total_time:.2f} ses.")
+    return failed
 
 
-folder_path = "YOUR-FOLDER-PATH"
+#%% Parameters
+# The cells run only under __main__ (also when run in Spyder): the workers of the 'local'
+# backend import this script again on Windows and macOS, and must not scan the folder,
+# transcribe or mark files themselves.
+if __name__ == '__main__':
+    folder_path = "YOUR-FOLDER-PATH"
 
-process_audio_files(folder_path)
+    # Frames, audio and transcripts of every clip; only new or changed files are hashed again
+    manifest = build_manifest(folder_path, 'manifest.json')
+
+    # Whisper API; rate limits of the account, when left as None they are read from the response headers
+    backend = make_backend('openai', scheduler=RateLimitScheduler(rpm=None, tpm=None))
+    workers = 4
+
+    # Clips with less than 5% of voiced frames are not transcribed (None sends every clip)
+    min_speech_ratio = 0.05
+    # Transcripts starting with these phrases or with no_speech_prob over 0.6 are marked
+    start_phrases = ["thanks for watching", "thank you for watching"]
+    max_no_speech = 0.6
+
+    # Or Whisper on the local CPU (pip install faster-whisper), one model per core
+    # backend = make_backend('local', model_size='small', compute_type='int8')
+    # workers = None
+
+    failed = process_audio_files(folder_path, backend=backend, workers=workers, min_speech_ratio=min_speech_ratio,
+                                 start_phrases=start_phrases, max_no_speech=max_no_speech, manifest=manifest)
 
 #%% read and check the file
 
-import os
 import pandas as pd
 
-def load_transcriptions_to_dataframe(folder_path):
+def load_transcriptions_to_dataframe(manifest):
     data = []
-    for subfolder in os.listdir(folder_path):
-        subfolder_path = os.path.join(folder_path, subfolder)
-        if os.path.isdir(subfolder_path):
-            for filename in os.listdir(subfolder_path):
-                if filename.lower().endswith('.txt'):
-                    file_path = os.path.join(subfolder_path, filename)
-                    with open(file_path, 'r', encoding='utf-8') as file:
-                        transcription = file.read()
-                    data.append({'file_name': filename, 'transcription': transcription})
+    for subfolder in manifest['clips']:
+        for file_path in clip_files(manifest, subfolder, 'transcripts'):
+            with open(file_path, 'r', encoding='utf-8') as file:
+                transcription = file.read()
+            data.append({'file_name': os.path.basename(file_path), 'transcription': transcription})
     df = pd.DataFrame(data)
     return df
 
-df_transcriptions = load_transcriptions_to_dataframe(folder_path)
+if __name__ == '__main__':
+    df_transcriptions = load_transcriptions_to_dataframe(manifest)
 
-#%% mark 
+#%% mark
+# Transcripts are marked while they are transcribed; this re-checks the
+# transcripts of earlier runs against the phrases only.
 
-def identify_and_mark_transcriptions(folder_path, start_phrases):
+def identify_and_mark_transcriptions(manifest, start_phrases):
     marked_files = []
-    for subfolder in os.listdir(folder_path):
-        subfolder_path = os.path.join(folder_path, subfolder)
-        if os.path.isdir(subfolder_path):
-            for filename in os.listdir(subfolder_path):
-                if filename.lower().endswith('.txt'):
-                    file_path = os.path.join(subfolder_path, filename)
-                    with open(file_path, 'r', encoding='utf-8') as file:
-                        first_line = file.readline().strip().lower()
-                    # Check if the first line starts with any of the specified phrases
-                    if any(first_line.startswith(phrase.lower()) for phrase in start_phrases):
-                        marked_files.append(file_path[:-4])  # Append path without '.txt'
+    for subfolder in manifest['clips']:
+        for file_path in clip_files(manifest, subfolder, 'transcripts'):
+            with open(file_path, 'r', encoding='utf-8') as file:
+                first_line = file.readline()
+            # Check if the first line starts with any of the specified phrases
+            if is_hallucination(first_line, phrases=start_phrases)[0]:
+                marked_files.append(file_path[:-4])  # Append path without '.txt'
     
-    # Save the list of marked files to a text file
+    # Add them to the list of marked files, next to the ones marked during transcription
     if marked_files:
-        with open('marked_files_index.txt', 'w', encoding='utf-8') as index_file:
-            for file_path in marked_files:
-                index_file.write(file_path + '\n')
+        mark_files(marked_files, 'marked_files_index.txt')
 
 # Example usage:
-start_phrases = ["thanks for watching", "thank you for watching"]
-identify_and_mark_transcriptions(folder_path, start_phrases)
+# if __name__ == '__main__':
+#     identify_and_mark_transcriptions(manifest, start_phrases)
 
 
 
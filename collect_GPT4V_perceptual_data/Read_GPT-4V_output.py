@@ -1,6 +1,6 @@
 # -*- coding: utf-8 -*-
 """
-Read the .json file of the GPT output
+Read the .jsonl (or older pretty-printed .json) file of the GPT output
 
 @author: 吴雨航 Yuhang Wu
 @Email: wuyuhang@ruc.edu.cn 
@@ -10,84 +10,69 @@ Last modified: 21/4/2024
 """
 
 
-import json
+from output_records import iter_records, response_content
 
 file_path = 'YOUR-JSON-FILE'
 
+def iter_extract(file_path):
+    """ (item id, content) of the last record of every item in an output file.
+
+    A re-queued item is written to the output file again; only its latest
+    answer is kept, in the place of the first one. Records of older outputs
+    without an id are all kept.
+    """
+    latest = {}
+    for n, record in enumerate(iter_records(file_path)):
+        key = record['id'] if record['id'] is not None else n
+        latest[key] = (record['id'], response_content(record['response']))
+    for item_id, content in latest.values():
+        if content is not None:
+            yield item_id, content
+
 def load_and_extract(file_path):
-    extracted_contents = []
-    
-    # Open the file and read line by line
-    with open(file_path, 'r', encoding='utf-8') as file:
-        json_object = ''
-        for line in file:
-            json_object += line.strip()
-            if line.startswith('}'):  # Checks if the line indicates the end of a JSON object
-                try:
-                    # Parse the JSON object
-                    data = json.loads(json_object)
-                    # Reset the JSON object string
-                    json_object = ''
-                    # Extract the desired content from the parsed JSON object
-                    if 'error' in data:  
-                        content = data['error'].get('message', '')
-                        extracted_contents.append(content)
-                    elif 'choices' in data and len(data['choices']) > 0:
-                        content = data['choices'][0]['message']['content']
-                        extracted_contents.append(content)
-                except json.JSONDecodeError as e:
-                    print(f"Error decoding JSON: {e}")
-                    # Reset the JSON object string in case of a decoding error
-                    json_object = ''
-
-    return extracted_contents
-
-
-contents = load_and_extract(file_path)
+    """ The item ids and the contents, one per item. """
+    pairs = list(iter_extract(file_path))
+    return [item_id for item_id, _ in pairs], [content for _, content in pairs]
+
+
+ids, contents = load_and_extract(file_path)
 
 #%% Convert into dataframe
 
 import pandas as pd
-import numpy as np
-import re
-
-def parse_content(content):
-    # Check if the content is unavailable
-    if content.strip().startswith("{I'm sorry}"):
-        return {"Data Unavailable": np.nan}
-
-    # Split the content string into lines
-    lines = content.split('\n')
-    
-    # Prepare a dictionary to hold the feature-score pairs
-    feature_scores = {}
-    
-    # Define a regular expression to match lines with features and scores
-    line_regex = re.compile(r'^(.+?)[\t\|\:,\s]+\s*(\d+)\s*(?:\(\s*[^)]*\))?\s*$')
-
-    
-    for line in lines:
-        match = line_regex.match(line.strip())
-        if match:
-            feature, score = match.groups()
-            try:
-                # Convert score to float and store in the dictionary
-                feature_scores[feature.strip()] = float(score)
-            except ValueError:
-                # Handle the case where conversion fails
-                feature_scores[feature.strip()] = np.nan
-    
-    return feature_scores
-
-parsed_contents = [parse_content(content) for content in contents]
-
-df = pd.DataFrame(parsed_contents)
 
+# Fixed 138 columns in the order of the prompt; misspelt feature names are matched to their feature
+# JSON answers (json_output in the experiments) are decoded directly, text answers line by line
+from feature_parser import FeatureParser
+from feature_schema import FEATURES
+
+parser = FeatureParser()
+ratings = parser.parse_all(contents)  # float32, items x 138
+parser.report()  # response lines that could not be matched to any feature, and the fuzzy matches to check
+
+df = pd.DataFrame(ratings, columns=FEATURES, index=ids)
+
+# The ratings, and the items of the rows in the same order (the order file of the R preprocessing)
 # df.to_csv('YOUR_FILE.csv', index=False)
+# pd.Series(ids).to_csv('YOUR_ORDER_FILE.csv', index=False, header=False)
+
+#%% Columnar results store
+
+# Parse the output file into the Parquet dataset of all batches (modality 'frame' for the image
+# experiment, 'clip' for the video experiment); storing the same file again replaces its rows
+from results_store import load_results, store_output_file
+
+store_output_file(file_path, 'results', modality='frame')
+
+# Any batches and features, read without parsing the other files, e.g.
+# import pyarrow.dataset as ds
+# df = load_results('results', modality='frame', batches=['batch1', 'batch2'], features=['Dominant', 'Warm'],
+#                   filter=ds.field('Dominant') > 50)
+df = load_results('results', modality='frame')
 
 #%% deal with the NAN
-import pandas as pd
-df = pd.read_csv('YOUR_FILE.csv')
+# The ratings of the output file, one row per item id
+df = pd.DataFrame(ratings, columns=FEATURES, index=ids)
 df = df.dropna(axis=1, how='all')
 
 empty_rows = df.index[df.isnull().all(axis=1)].tolist()
@@ -97,25 +82,17 @@ nan_rows_df = df[df.isnull().any(axis=1)]
 # columns_with_null = df.columns[df.isnull().any()].tolist()
 # all_null_columns = df.columns[df.isnull().all()].tolist()
 
-with open('processed.txt', 'r') as file:
-    lines = file.readlines()
-
-empty_rows_content = [lines[i] for i in empty_rows]
-
-import shutil
-import os
+# Mark the items without ratings as failed in the resume index of the experiment.
+# Re-queue them and run the experiment again to send only these items.
+from resume_index import ResumeIndex
 
-source_folder = 'YOUR_SOURCE_FOLDER'
-target_folder = 'YOUR_TARGET_FOLDER'
+# progress.txt for the image experiment, processed.txt for the video experiment
+progress_file = 'progress.txt'
 
+index = ResumeIndex.for_progress_file(progress_file)
+for item_id in empty_rows:
+    if item_id is not None:  # older outputs do not name the item
+        index.mark_failed(item_id, 'no ratings in the response')
 
-for file_name in empty_rows_content:
-    file_name = file_name.strip()
-    source_path = os.path.join(source_folder, file_name)
-    target_path = os.path.join(target_folder, file_name)
-    
-    if os.path.exists(source_path):
-        shutil.copy(source_path, target_path)
-        print(f"'{file_name}' has been copied to '{target_folder}'.")
-    else:
-        print(f"'{file_name}' not found in '{source_folder}'.")
+requeued = index.requeue_failed()
+print(f"Re-queued {len(requeued)} items for the next run.")
@@ -13,6 +13,12 @@ Last modified: 15/5/2024
 import math
 import subprocess
 import os
+import struct
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from rate_limiter import estimate_image_tokens
 
 #%% Extract vedio and audio at the same time 
 
@@ -42,25 +48,182 @@ def extract_audio(video_path, output_folder, video_filename):
     command = ['ffmpeg', '-i', video_path, '-vn', '-acodec', 'libmp3lame', audio_output_file]
     subprocess.run(command, capture_output=True)
 
-video_folder = 'YOUR_SOURCE_FOLDER' 
-output_folder = 'YOUR_TARGET_FOLDER'  
+def mp4_info(video_path):
+    # Read the duration (moov/mvhd) and whether there is an audio track (trak/mdia/hdlr)
+    # from the boxes of the mp4 without starting ffprobe
+    duration = None
+    has_audio = False
+    containers = (b'moov', b'trak', b'mdia')
+    with open(video_path, 'rb') as f:
+        ends = [os.fstat(f.fileno()).st_size]
+        while ends:
+            if f.tell() + 8 > ends[-1]:
+                f.seek(ends.pop())
+                continue
+            start = f.tell()
+            size, kind = struct.unpack('>I4s', f.read(8))
+            if size == 1:
+                size = struct.unpack('>Q', f.read(8))[0]
+            elif size == 0:
+                size = ends[-1] - start
+            if size < 8:
+                break
+            if kind in containers:
+                ends.append(start + size)  # read the boxes inside
+                continue
+            if kind == b'mvhd':
+                version = f.read(4)[0]
+                if version == 1:
+                    _, _, timescale, length = struct.unpack('>QQIQ', f.read(28))
+                else:
+                    _, _, timescale, length = struct.unpack('>IIII', f.read(16))
+                duration = length / timescale
+            elif kind == b'hdlr':
+                f.read(8)
+                has_audio = has_audio or f.read(4) == b'soun'
+            f.seek(start + size)
+    return duration, has_audio
+
+def frame_seconds(duration):
+    if duration <= 10:
+        # If the video length is less than 10 seconds, extract the frames at 1/4 and 3/4
+        return [duration * 0.25, duration * 0.75]
+    return [duration * 0.125, duration * 0.375, duration * 0.625, duration * 0.875]
+
+#%% Adaptive frame sampling
+
+def video_size(video_path):
+    # Width and height of the first video stream
+    command = ['ffprobe', '-v', 'error', '-select_streams', 'v:0', '-show_entries', 'stream=width,height',
+               '-of', 'csv=p=0:s=x', video_path]
+    result = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    width, height = result.stdout.decode().strip().split('x')[:2]
+    return int(width), int(height)
+
+def thumbnail_stream(video_path, fps=4, size=(64, 36)):
+    """ Times and small grayscale thumbnails of the video, decoded at fps in one ffmpeg run. """
+    width, height = size
+    command = ['ffmpeg', '-v', 'error', '-threads', '1', '-i', video_path, '-map', '0:v:0',
+               '-vf', f"fps={fps},scale={width}:{height},format=gray", '-f', 'rawvideo', '-']
+    result = subprocess.run(command, capture_output=True)
+    if result.returncode != 0:
+        raise RuntimeError(f"ffmpeg failed for {video_path}: {result.stderr.decode(errors='replace')[-500:]}")
+    thumbnails = np.frombuffer(result.stdout, dtype=np.uint8).reshape(-1, height * width).astype(np.float32) / 255
+    return np.arange(len(thumbnails)) / fps, thumbnails
+
+def choose_frames(times, thumbnails, max_frames=4, min_change=0.03, cut_threshold=0.15, spread=0.05):
+    """ Times of up to max_frames thumbnails that differ most from each other.
+
+    The first pick is the middle of the longest shot (shots end at a change
+    of more than cut_threshold between two thumbnails). Each next pick is the
+    thumbnail furthest (mean absolute difference) from all picks so far, with
+    a bonus of up to spread for lying far in time from them; picks stop early
+    when nothing differs by more than min_change, so static clips get fewer
+    frames and fast-cut clips get one frame per distinct shot.
+    """
+    if len(thumbnails) == 0:
+        return []
+    change = np.abs(np.diff(thumbnails, axis=0)).mean(axis=1)
+    cuts = np.flatnonzero(change > cut_threshold) + 1
+    bounds = np.concatenate(([0], cuts, [len(thumbnails)]))
+    longest = np.argmax(np.diff(bounds))
+    chosen = [(bounds[longest] + bounds[longest + 1] - 1) // 2]
+    # Frames right at a cut are often blended; keep them as candidates of last resort
+    penalty = np.zeros(len(thumbnails), dtype=np.float32)
+    penalty[cuts] = penalty[np.maximum(cuts - 1, 0)] = cut_threshold
+
+    length = max(times[-1] - times[0], 1e-6)
+    distance = np.abs(thumbnails - thumbnails[chosen[0]]).mean(axis=1)
+    gap = np.abs(times - times[chosen[0]]) / length
+    while len(chosen) < max_frames:
+        candidate = int(np.argmax(distance + spread * gap - penalty))
+        if distance[candidate] < min_change:
+            break
+        chosen.append(candidate)
+        distance = np.minimum(distance, np.abs(thumbnails - thumbnails[candidate]).mean(axis=1))
+        gap = np.minimum(gap, np.abs(times - times[candidate]) / length)
+    return sorted(float(times[i]) for i in chosen)
 
-if not os.path.exists(output_folder):
-    os.makedirs(output_folder)
+def adaptive_frame_seconds(video_path, duration=None, max_frames=4, token_budget=None, detail='high', fps=4,
+                           min_change=0.03, cut_threshold=0.15):
+    """ Seconds of the most informative frames of a video, within a token budget per clip.
 
-for file in os.listdir(video_folder):
-    if file.endswith(".mp4"):
-        video_path = os.path.join(video_folder, file)
-        # Get video duration
+    A drop-in for frame_seconds: the number of frames is at most max_frames
+    and what token_budget pays for at the detail level, and fewer when the
+    clip hardly changes.
+    """
+    if token_budget is not None:
+        try:
+            width, height = video_size(video_path)
+        except (ValueError, OSError):
+            width, height = None, None
+        max_frames = min(max_frames, max(1, token_budget // estimate_image_tokens(width, height, detail)))
+    times, thumbnails = thumbnail_stream(video_path, fps)
+    seconds = choose_frames(times, thumbnails, max_frames, min_change, cut_threshold)
+    if not seconds and duration is not None:
+        return frame_seconds(duration)[:max_frames]  # nothing decoded; fall back to the fixed times
+    return seconds
+
+def extract_clip(video_path, output_folder, video_filename, sampler=None):
+    """ Extract the frames and the audio of one video with a single ffmpeg run.
+
+    sampler(video_path, duration) returns the seconds of the frames; by
+    default the fixed times of frame_seconds.
+    """
+    try:
+        duration, has_audio = mp4_info(video_path)
+    except (OSError, IndexError, struct.error, ZeroDivisionError):
+        duration, has_audio = None, True
+    if duration is None:
         duration = get_video_duration(video_path)
-        extract_audio(video_path, output_folder, file)  # Extract audio
-        if duration <= 10:
-            # If the video length is less than 10 seconds, extract the frames at 1/4 and 3/4
-            extract_frame_at_second(video_path, output_folder, duration * 0.25, file)
-            extract_frame_at_second(video_path, output_folder, duration * 0.75, file)
-        else:
-            extract_frame_at_second(video_path, output_folder, duration * 0.125, file)  
-            extract_frame_at_second(video_path, output_folder, duration * 0.375, file)  
-            extract_frame_at_second(video_path, output_folder, duration * 0.625, file)  
-            extract_frame_at_second(video_path, output_folder, duration * 0.875, file)
 
+    video_basename = os.path.splitext(video_filename)[0]
+    video_output_folder = os.path.join(output_folder, video_basename)
+    os.makedirs(video_output_folder, exist_ok=True)
+
+    # The video is decoded once; every frame output picks the first frame at or after its time
+    command = ['ffmpeg', '-v', 'error', '-y', '-threads', '1', '-i', video_path]
+    seconds = sampler(video_path, duration) if sampler is not None else frame_seconds(duration)
+    for second in seconds:
+        output_file = os.path.join(video_output_folder, f"frame_{second:.1f}s.png")
+        command += ['-map', '0:v:0', '-vf', f"select=gte(t\\,{second:.3f})", '-frames:v', '1', output_file]
+    if has_audio:
+        audio_output_file = os.path.join(video_output_folder, f"{video_basename}.mp3")
+        command += ['-map', '0:a:0', '-vn', '-acodec', 'libmp3lame', audio_output_file]
+    result = subprocess.run(command, capture_output=True)
+    if result.returncode != 0:
+        print(f"ffmpeg failed for {video_filename}: {result.stderr.decode(errors='replace')[-500:]}")
+    return video_filename, result.returncode
+
+def process_videos(video_folder, output_folder, workers=None, sampler=None):
+    """ Extract all videos of a folder in parallel, one ffmpeg process per core. """
+    os.makedirs(output_folder, exist_ok=True)
+    videos = [file for file in os.listdir(video_folder) if file.endswith(".mp4")]
+    with ProcessPoolExecutor(max_workers=workers or os.cpu_count()) as executor:
+        futures = [executor.submit(extract_clip, os.path.join(video_folder, file), output_folder, file, sampler)
+                   for file in videos]
+        failed = []
+        for file, future in zip(videos, futures):
+            try:
+                _, returncode = future.result()
+            except (RuntimeError, OSError, ValueError, IndexError, struct.error) as e:
+                # e.g. a video without a duration ffprobe could read
+                print(f"Failed to extract {file}: {e!r}")
+                returncode = None
+            if returncode != 0:
+                failed.append(file)
+    print(f"Extracted {len(videos) - len(failed)} of {len(videos)} videos.")
+    return failed
+
+video_folder = 'YOUR_SOURCE_FOLDER' 
+output_folder = 'YOUR_TARGET_FOLDER'  
+
+# Fixed times (2 or 4 frames); or choose up to 4 frames by the content of each clip, at most
+# what 1500 image tokens pay for at high detail (must be picklable for the worker processes):
+# from functools import partial
+# sampler = partial(adaptive_frame_seconds, max_frames=4, token_budget=1500, detail='high')
+sampler = None
+
+# The guard keeps the worker processes from running this part again when they start
+if __name__ == '__main__':
+    process_videos(video_folder, output_folder, sampler=sampler)
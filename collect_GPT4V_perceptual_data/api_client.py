@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+"""
+
+Sending chat completion requests to the GPT API with pacing and retries
+
+The API address is read from OPENAI_BASE_URL like the official client does,
+so a local stub server (e.g. http://127.0.0.1:8000/v1) can stand in for
+api.openai.com when testing.
+
+"""
+import http.client
+import json
+import os
+import time
+from urllib.parse import urlsplit
+
+from output_records import response_error
+from rate_limiter import estimate_payload_tokens, is_retryable, retry_after
+
+API_BASE_URL = os.environ.get('OPENAI_BASE_URL', 'https://api.openai.com/v1')
+CHAT_COMPLETIONS_PATH = urlsplit(API_BASE_URL).path.rstrip('/') + '/chat/completions'
+
+def make_connection(base_url=API_BASE_URL):
+    url = urlsplit(base_url)
+    if url.scheme == 'http':
+        return http.client.HTTPConnection(url.hostname, url.port)
+    return http.client.HTTPSConnection(url.hostname, url.port)
+
+def post_with_backoff(pool, payload, headers, scheduler, label='', max_attempts=3,
+                      path=CHAT_COMPLETIONS_PATH, cache=None, metrics=None):
+    """ POST a payload (dict or JSON string) through the scheduler, retrying 429/5xx and network errors.
+
+    Connections are taken from the pool and given back afterwards; a
+    connection that failed is closed instead of being reused.
+    Returns the decoded JSON response, or None if every attempt failed.
+    Other error responses (e.g. 400) are returned as is, like before.
+    With a ResponseCache, a payload that was answered before is not sent again
+    (only 200 responses that are not refusals or empty answers are stored).
+    With a MetricsLog, the timings, tokens and statuses of the item are recorded.
+    """
+    model = payload.get('model') if isinstance(payload, dict) else None
+    if cache is not None:
+        cached = cache.get(payload)
+        if cached is not None:
+            if metrics is not None:
+                metrics.record(item=label, model=model, cached=True, status=200, statuses=[], retries=0,
+                               queue_wait=0.0, total=0.0, usage=cached.get('usage'))
+            return cached
+
+    tokens = estimate_payload_tokens(payload)
+    if isinstance(payload, dict):
+        payload = json.dumps(payload)
+    start = time.perf_counter()
+    queue_wait = 0.0
+    statuses = []
+    response = None
+    for attempt in range(max_attempts):
+        queued = time.perf_counter()
+        scheduler.acquire(tokens)
+        sent = time.perf_counter()
+        queue_wait += sent - queued
+        conn = pool.acquire()
+        ttfb = latency = None
+        try:
+            conn.request("POST", path, payload, headers)
+            res = conn.getresponse()
+            ttfb = time.perf_counter() - sent
+            data = res.read()
+            latency = time.perf_counter() - sent
+            scheduler.update_from_headers(res.getheaders())
+        except Exception as e:
+            pool.release(conn, broken=True)
+            statuses.append(type(e).__name__)
+            if attempt == max_attempts - 1:
+                print(f"Error processing {label}: {e}, giving up.")
+                break
+            delay = scheduler.backoff(attempt, shared=False)
+            print(f"Error processing {label}: {e}, retrying in {delay:.1f} seconds.")
+            time.sleep(delay)
+            continue
+        pool.release(conn, broken=res.will_close)
+        statuses.append(res.status)
+
+        if is_retryable(res.status):
+            if attempt == max_attempts - 1:
+                print(f"HTTP {res.status} for {label}, giving up.")
+                break
+            # Only rate limiting pauses the other requests too
+            server_delay = retry_after(res.getheaders())
+            delay = scheduler.backoff(attempt, server_delay,
+                                      shared=res.status == 429 or server_delay is not None)
+            print(f"HTTP {res.status} for {label}, retrying in {delay:.1f} seconds.")
+            time.sleep(delay)
+            continue
+
+        try:
+            response = json.loads(data.decode("utf-8"))
+        except ValueError as e:
+            print(f"Error decoding response for {label}: {e}")
+            statuses[-1] = 'invalid_json'
+            if attempt < max_attempts - 1:
+                time.sleep(scheduler.backoff(attempt, shared=False))
+            continue
+
+        # Only answers with ratings are kept; an error (e.g. 400), refusal or empty answer
+        # must be sent again after requeue_failed
+        if cache is not None and res.status == 200 and response_error(response) is None:
+            cache.put(payload, response)
+        break
+
+    if metrics is not None:
+        metrics.record(item=label, model=model or (response or {}).get('model'), cached=False,
+                       status=statuses[-1] if statuses else None, statuses=statuses,
+                       retries=len(statuses) - 1, queue_wait=round(queue_wait, 4),
+                       ttfb=None if ttfb is None else round(ttfb, 4),
+                       latency=None if latency is None else round(latency, 4),
+                       total=round(time.perf_counter() - start, 4), payload_bytes=len(payload),
+                       usage=(response or {}).get('usage'))
+    return response
@@ -0,0 +1,29 @@
+# -*- coding: utf-8 -*-
+"""
+
+Concurrent request engine for the GPT API experiment scripts
+
+Keeps a bounded number of requests in flight with asyncio. The requests
+themselves are sent with http.client on a small pool of worker threads that
+share one keep-alive ConnectionPool, so no extra HTTP library is needed.
+
+"""
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+
+async def run_bounded(items, worker, max_in_flight=8):
+    """ Run worker(item) for all items with at most max_in_flight running at once.
+
+    worker is a blocking function; it runs on a thread pool of the same size
+    as the in-flight limit. Returns the worker results in the order of items.
+    """
+    loop = asyncio.get_running_loop()
+    semaphore = asyncio.Semaphore(max_in_flight)
+
+    with ThreadPoolExecutor(max_workers=max_in_flight) as executor:
+        async def run_one(item):
+            async with semaphore:
+                return await loop.run_in_executor(executor, worker, item)
+
+        return await asyncio.gather(*(run_one(item) for item in items))
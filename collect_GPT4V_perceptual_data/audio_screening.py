@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+"""
+
+Screening of the audio before and after transcription
+
+Before: a cheap voice activity check on the decoded audio (16 kHz mono
+through ffmpeg). A 30 ms frame counts as voice when it rises above the noise
+floor, most of its energy lies in the voice band (300-3400 Hz) and its
+spectrum there is not flat. Clips with hardly any such frame (silence, room
+tone, hum, wind or hiss) are not sent to Whisper at all. Music with a melody
+in the voice band still passes; that is left to no_speech_prob below.
+
+After: Whisper tends to invent text such as "Thanks for watching" for clips
+without speech. A transcript is flagged when it starts with one of the
+hallucination phrases or when Whisper itself scores it as probably no speech
+(no_speech_prob). Flagged transcripts are appended to marked_files_index.txt
+(path without .txt, one per line), the file the video experiment reads to
+leave those transcripts out.
+
+"""
+import subprocess
+
+import numpy as np
+
+HALLUCINATION_PHRASES = ["thanks for watching", "thank you for watching"]
+
+def decode_pcm(audio_path, sample_rate=16000):
+    """ Decode an audio file to mono float samples in [-1, 1]. """
+    command = ['ffmpeg', '-v', 'error', '-i', audio_path, '-map', '0:a:0', '-ac', '1',
+               '-ar', str(sample_rate), '-f', 's16le', '-']
+    result = subprocess.run(command, capture_output=True)
+    if result.returncode != 0:
+        raise RuntimeError(f"ffmpeg failed for {audio_path}: {result.stderr.decode(errors='replace')[-500:]}")
+    return np.frombuffer(result.stdout, dtype=np.int16).astype(np.float32) / 32768
+
+def speech_ratio(samples, sample_rate=16000, frame_ms=30, margin_db=10, min_db=-45,
+                 voice_band=(300, 3400), min_band_share=0.5, max_flatness=0.4):
+    """ Share of frames that look like voice.
+
+    A frame counts when its level is margin_db over the noise floor
+    (10th percentile of the frame levels) and above min_db dBFS, at least
+    min_band_share of its energy is in voice_band, and the spectral flatness
+    in that band (1 for white noise, near 0 for the harmonics of a voice) is
+    at most max_flatness. Tonal music in the voice band is not told apart.
+    """
+    frame = int(sample_rate * frame_ms / 1000)
+    n_frames = len(samples) // frame
+    if n_frames == 0:
+        return 0.0
+    frames = samples[:n_frames * frame].reshape(n_frames, frame)
+    levels = 10 * np.log10(np.mean(frames ** 2, axis=1) + 1e-10)
+    threshold = max(np.percentile(levels, 10) + margin_db, min_db)
+    loud = levels > threshold
+    if not loud.any():
+        return 0.0
+
+    power = np.abs(np.fft.rfft(frames[loud] * np.hanning(frame), axis=1)) ** 2 + 1e-12
+    freqs = np.fft.rfftfreq(frame, 1 / sample_rate)
+    band = (freqs >= voice_band[0]) & (freqs <= voice_band[1])
+    band_share = power[:, band].sum(axis=1) / power.sum(axis=1)
+    flatness = np.exp(np.mean(np.log(power[:, band]), axis=1)) / np.mean(power[:, band], axis=1)
+    voiced = (band_share >= min_band_share) & (flatness <= max_flatness)
+    return float(np.sum(voiced) / n_frames)
+
+def has_speech(audio_path, min_ratio=0.05):
+    """ Whether a clip is worth transcribing; returns (decision, speech ratio). """
+    ratio = speech_ratio(decode_pcm(audio_path))
+    return ratio >= min_ratio, ratio
+
+def is_hallucination(text, no_speech_prob=None, phrases=HALLUCINATION_PHRASES, max_no_speech=0.6):
+    """ Whether a transcript looks made up; returns (decision, reason). """
+    first_line = text.strip().split('\n', 1)[0].strip().lower()
+    for phrase in phrases:
+        if first_line.startswith(phrase.lower()):
+            return True, f"starts with '{phrase}'"
+    if no_speech_prob is not None and no_speech_prob > max_no_speech:
+        return True, f"no_speech_prob {no_speech_prob:.2f}"
+    return False, None
+
+def mark_files(file_paths, index_file='marked_files_index.txt'):
+    """ Append transcripts (paths without .txt) to the index of marked files. """
+    with open(index_file, 'a', encoding='utf-8') as f:
+        for file_path in file_paths:
+            f.write(file_path + '\n')
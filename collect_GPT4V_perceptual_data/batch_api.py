@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+"""
+
+Batch API mode for the experiment scripts
+
+Instead of calling the API item by item, the request bodies are written to
+compact JSONL job files (one line per image or video, custom_id = file or
+subfolder name) that are submitted to the Batch API. The returned result
+file is then joined back to the inputs and written in the same format as the
+interactive scripts, so Read_GPT-4V_output.load_and_extract reads it as is.
+
+run_batch_locally stands in for the remote batch service when testing: it
+sends every request of a job file to OPENAI_BASE_URL (e.g. a local stub
+server) and writes a result file in the Batch API format.
+
+Ref: https://platform.openai.com/docs/guides/batch
+
+"""
+import json
+import os
+
+from api_client import CHAT_COMPLETIONS_PATH, post_with_backoff
+from output_records import append_record, response_error
+
+BATCH_URL = '/v1/chat/completions'
+MAX_FILE_BYTES = 190 * 1024 * 1024  # the Batch API accepts files up to 200 MB
+
+#%% Job files
+
+def write_batch_requests(requests, batch_file, max_file_bytes=MAX_FILE_BYTES):
+    """ Write (custom_id, payload) pairs as Batch API request lines.
+
+    When a file would grow over max_file_bytes the rest goes to numbered
+    parts (batch1.jsonl, batch1_part1.jsonl, ...). Returns the written files.
+    """
+    root, ext = os.path.splitext(batch_file)
+    files = []
+    outfile = None
+    size = 0
+    for custom_id, payload in requests:
+        line = json.dumps({"custom_id": custom_id, "method": "POST", "url": BATCH_URL, "body": payload},
+                          ensure_ascii=False, separators=(',', ':')) + '\n'
+        line = line.encode('utf-8')
+        if outfile is None or (size and size + len(line) > max_file_bytes):
+            if outfile is not None:
+                outfile.close()
+            path = batch_file if not files else f"{root}_part{len(files)}{ext}"
+            outfile = open(path, 'wb')
+            files.append(path)
+            size = 0
+        outfile.write(line)
+        size += len(line)
+    if outfile is not None:
+        outfile.close()
+    return files
+
+def read_custom_ids(batch_files):
+    custom_ids = []
+    for path in batch_files:
+        with open(path, 'r', encoding='utf-8') as f:
+            for line in f:
+                if line.strip():
+                    custom_ids.append(json.loads(line)['custom_id'])
+    return custom_ids
+
+#%% Results
+
+def ingest_batch_results(batch_files, result_files, output_file, progress_file, batch=None, index=None):
+    """ Join Batch API results back to the job files, in the order of the inputs.
+
+    Each result is appended to output_file as a record like the interactive
+    scripts write, and its custom_id to progress_file, so the rows of the two files match.
+    Failed requests are saved as error objects; items without any result
+    are left out so that they are picked up again on the next run.
+    With a ResumeIndex the items are also marked done or failed.
+    Returns the list of custom_ids without a result.
+    """
+    results = {}
+    for path in result_files:
+        with open(path, 'r', encoding='utf-8') as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                result = json.loads(line)
+                response = result.get('response') or {}
+                if response.get('body') is not None:
+                    results[result['custom_id']] = response['body']
+                elif result.get('error'):
+                    results[result['custom_id']] = {"error": result['error']}
+
+    missing = []
+    with open(output_file, 'a', encoding='utf-8') as outfile, open(progress_file, 'a') as progress:
+        for custom_id in read_custom_ids(batch_files):
+            if custom_id not in results:
+                missing.append(custom_id)
+                continue
+            append_record(outfile, custom_id, results[custom_id], batch)
+            progress.write(custom_id + '\n')
+            if index is not None:
+                error = response_error(results[custom_id])
+                if error is None:
+                    index.mark_done(custom_id)
+                else:
+                    index.mark_failed(custom_id, error)
+
+    print(f"Ingested {len(results)} results, {len(missing)} items without a result.")
+    return missing
+
+#%% Submitting
+
+def submit_batch(client, batch_file, completion_window='24h'):
+    """ Upload a job file and start a batch; returns the batch object. """
+    with open(batch_file, 'rb') as f:
+        uploaded = client.files.create(file=f, purpose='batch')
+    return client.batches.create(input_file_id=uploaded.id, endpoint=BATCH_URL,
+                                 completion_window=completion_window)
+
+def download_batch_results(client, batch_id, result_file):
+    """ Save the output (and error) file of a finished batch; returns its status. """
+    batch = client.batches.retrieve(batch_id)
+    if batch.status != 'completed':
+        return batch.status
+    with open(result_file, 'wb') as f:
+        for file_id in (batch.output_file_id, batch.error_file_id):
+            if file_id:
+                f.write(client.files.content(file_id).read())
+    return batch.status
+
+def run_batch_locally(batch_file, result_file, pool, scheduler):
+    """ Stand-in for the batch service: send each job line and write Batch API style results. """
+    with open(batch_file, 'r', encoding='utf-8') as f, open(result_file, 'w', encoding='utf-8') as out:
+        for n, line in enumerate(f):
+            if not line.strip():
+                continue
+            request = json.loads(line)
+            body = post_with_backoff(pool, request['body'], {'Content-Type': 'application/json'},
+                                     scheduler, label=request['custom_id'], path=CHAT_COMPLETIONS_PATH)
+            if body is None:
+                result = {"id": f"local-{n}", "custom_id": request['custom_id'], "response": None,
+                          "error": {"code": "failed", "message": "request failed after retries"}}
+            else:
+                result = {"id": f"local-{n}", "custom_id": request['custom_id'],
+                          "response": {"status_code": 200, "body": body}, "error": None}
+            out.write(json.dumps(result, ensure_ascii=False) + '\n')
@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+"""
+
+Repeated rating batches in one run
+
+The study rates every item in several independent batches (batch1..batch5).
+Instead of running the experiment once per batch, run_repeated_batches
+interleaves the requests of all batches (item 1 of batch1..N, item 2 of
+batch1..N, ...) through one shared in-flight limit, rate limit scheduler
+and connection pool, so the whole design takes about the wall time of one
+batch when the account limits allow it.
+
+Every batch keeps its own output file, progress file and resume index
+(e.g. output_batch3.jsonl, progress_batch3.txt), so each batch resumes on
+its own and the files look the same as from a single-batch run.
+
+The response cache is not used here: the batches send identical payloads
+and must get independent answers.
+
+"""
+import threading
+import time
+
+from api_client import post_with_backoff
+from async_engine import run_bounded
+from connection_pool import ConnectionPool
+from output_records import ResultWriter
+from rate_limiter import RateLimitScheduler
+from resume_index import ResumeIndex
+
+def batch_names(n_batches, first=1):
+    return [f"batch{n}" for n in range(first, first + n_batches)]
+
+async def run_repeated_batches(item_ids, build_payload, batches, headers, output_pattern='output_{batch}.jsonl',
+                               progress_pattern='progress_{batch}.txt', max_in_flight=8, scheduler=None,
+                               pool=None, metrics=None, experiment=None, validator=None):
+    """ Rate every item once in every batch, all batches sharing one request budget.
+
+    build_payload(item_id) returns the request body of an item; it is built
+    once and sent for all the batches that still need the item. An item
+    whose payload cannot be built (e.g. a corrupt frame) is marked failed in
+    all those batches and the run goes on.
+    The patterns name the files of each batch, e.g. 'output_{batch}.jsonl'.
+    With a ResponseValidator, incomplete answers are completed before they are saved.
+    """
+    start_time = time.time()
+
+    # All batches share one budget
+    if scheduler is None:
+        scheduler = RateLimitScheduler()
+    if pool is None:
+        pool = ConnectionPool(max_idle=max_in_flight)
+
+    writers = {}
+    jobs = {}
+    for batch in batches:
+        progress_file = progress_pattern.format(batch=batch)
+        index = ResumeIndex.for_progress_file(progress_file)
+        writers[batch] = ResultWriter(output_pattern.format(batch=batch), progress_file, batch, index)
+        completed = index.completed()
+        for item_id in item_ids:
+            if item_id not in completed:
+                jobs.setdefault(item_id, []).append(batch)
+
+    # The payload of an item is kept until the last of its batches has sent it
+    payloads = {}
+    remaining = {item_id: len(item_batches) for item_id, item_batches in jobs.items()}
+    item_locks = {item_id: threading.Lock() for item_id in jobs}
+    lock = threading.Lock()
+    counts = {batch: 0 for batch in batches}
+    batch_metrics = {batch: metrics.with_fields(batch=batch, experiment=experiment) if metrics else None
+                     for batch in batches}
+
+    def get_payload(item_id):
+        with item_locks[item_id]:
+            if item_id not in payloads:
+                try:
+                    payloads[item_id] = build_payload(item_id)
+                except Exception as e:
+                    # Kept, so the other batches of the item fail the same way without building it again
+                    payloads[item_id] = e
+            return payloads[item_id]
+
+    def process_one(job):
+        item_id, batch = job
+        writer = writers[batch]
+        try:
+            payload = get_payload(item_id)
+            if isinstance(payload, Exception):
+                print(f"Failed to build the request of {item_id} for {batch}: {payload}")
+                writer.index.mark_failed(item_id, f"payload: {payload}")
+                return False
+            writer.index.mark_in_flight(item_id)
+            send = validator.post if validator is not None else post_with_backoff
+            response = send(pool, payload, headers, scheduler, label=f"{item_id} ({batch})",
+                            metrics=batch_metrics[batch])
+            if response is None:
+                print(f"Failed to process {item_id} in {batch} after 3 attempts.")
+                writer.index.mark_failed(item_id, 'request failed after 3 attempts')
+                return False
+
+            # Save the response and the progress of this batch
+            writer.write(item_id, response, payload["model"])
+            with lock:
+                counts[batch] += 1
+                done = sum(counts.values())
+            if done % 10 == 0:
+                elapsed_time = time.time() - start_time
+                print(f"Processed {done} of {len(job_list)} requests, elapsed time: {elapsed_time:.2f} seconds.")
+            return True
+        finally:
+            with lock:
+                remaining[item_id] -= 1
+                if remaining[item_id] == 0:
+                    payloads.pop(item_id, None)
+
+    # Interleave the batches item by item
+    job_list = [(item_id, batch) for item_id, item_batches in jobs.items() for batch in item_batches]
+    print(f"{len(job_list)} requests for {len(jobs)} items in {len(batches)} batches.")
+    await run_bounded(job_list, process_one, max_in_flight)
+
+    total_time = time.time() - start_time
+    print(f"Finished {sum(counts.values())} requests, total elapsed time: {total_time:.2f} seconds.")
+    for batch, writer in writers.items():
+        print(f"{batch}: {counts[batch]} new, items {writer.index.summary()}")
+    print(f"Connections: {pool.stats()}")
+    return counts
@@ -0,0 +1,177 @@
+# -*- coding: utf-8 -*-
+"""
+
+End-to-end throughput benchmark of the collectors against the mock API
+
+Starts mock_api_server on a local port, generates a folder of test images
+and a folder of test clips (frames and an mp3 each), and runs the real
+collector functions on them:
+
+image        process_images_and_save
+image_async  process_images_and_save_async
+audio        process_audio_files (Whisper API backend)
+video        process_media_files
+
+For every stage it reports items/sec, the latency percentiles of the
+requests (from the metrics log), the retries and the peak Python memory
+(tracemalloc). The results are saved as JSON; pass the file of an earlier
+run as baseline_file to see the change in throughput.
+
+"""
+import os
+
+MOCK_PORT = 8765
+# The API address is read when api_client is imported, so set it first
+os.environ['OPENAI_BASE_URL'] = f'http://127.0.0.1:{MOCK_PORT}/v1'
+os.environ.setdefault('OPENAI_API_KEY', 'mock-key')
+
+import asyncio
+import contextlib
+import io
+import json
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+from PIL import Image
+
+from clip_manifest import build_manifest
+from mock_api_server import start_server
+from rate_limiter import RateLimitScheduler
+from request_metrics import MetricsLog, load_metrics, summarize
+from script_loader import load_script
+from transcription_backends import OpenAIWhisperBackend
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+#%% Test data
+
+def make_test_data(work_folder, n_images=40, n_clips=20, frames_per_clip=4, size=(640, 360), seed=0):
+    rng = np.random.default_rng(seed)
+    image_folder = os.path.join(work_folder, 'images')
+    clip_folder = os.path.join(work_folder, 'clips')
+    os.makedirs(image_folder, exist_ok=True)
+
+    def noise_png(path):
+        Image.fromarray(rng.integers(0, 256, (size[1], size[0], 3), dtype=np.uint8)).save(path)
+
+    for n in range(n_images):
+        noise_png(os.path.join(image_folder, f"image_{n:04d}.png"))
+    for n in range(n_clips):
+        clip = os.path.join(clip_folder, f"clip_{n:04d}")
+        os.makedirs(clip, exist_ok=True)
+        for k in range(frames_per_clip):
+            noise_png(os.path.join(clip, f"frame_{1.5 + 3 * k:.1f}s.png"))
+        # The mock does not decode the audio, any bytes will do
+        with open(os.path.join(clip, f"clip_{n:04d}.mp3"), 'wb') as f:
+            f.write(rng.integers(0, 256, 64 * 1024, dtype=np.uint8).tobytes())
+    return image_folder, clip_folder
+
+
+class TimedWhisperBackend(OpenAIWhisperBackend):
+    # Whisper requests do not go through post_with_backoff, so time them here
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.latencies = []
+
+    def transcribe(self, file_path):
+        start = time.perf_counter()
+        result = super().transcribe(file_path)
+        self.latencies.append(time.perf_counter() - start)
+        return result
+
+#%% Benchmark
+
+def run_stage(name, n_items, function, quiet=True):
+    tracemalloc.start()
+    start = time.perf_counter()
+    output = io.StringIO()
+    with contextlib.redirect_stdout(output) if quiet else contextlib.nullcontext():
+        function()
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {'stage': name, 'items': n_items, 'seconds': round(elapsed, 3),
+            'items_per_sec': round(n_items / elapsed, 2), 'peak_memory_mb': round(peak / 1e6, 1)}
+
+def run_benchmark(work_folder=None, n_images=40, n_clips=20, max_in_flight=8, audio_workers=8,
+                  median=0.2, sigma=0.5, rate_429=0.02, rate_500=0.01, results_file='benchmark_results.json',
+                  baseline_file=None):
+    work_folder = work_folder or tempfile.mkdtemp(prefix='collector_benchmark_')
+    image_folder, clip_folder = make_test_data(work_folder, n_images, n_clips)
+    out = lambda name: os.path.join(work_folder, name)
+
+    server = start_server(MOCK_PORT, median=median, sigma=sigma, rate_429=rate_429, rate_500=rate_500)
+    image_script = load_script(os.path.join(HERE, 'GPT-4V_image_perception_experiment.py'))
+    video_script = load_script(os.path.join(HERE, 'GPT-4V_video_perception_experiment.py'))
+    audio_script = load_script(os.path.join(HERE, 'GPT-4V_video_perception_experiment_audio2text.py'))
+
+    metrics = MetricsLog(out('metrics.jsonl'))
+    manifest = build_manifest(clip_folder, out('manifest.json'))
+    whisper = TimedWhisperBackend(scheduler=RateLimitScheduler(base_delay=0.1))
+    stages = [
+        ('image', n_images, lambda: image_script['process_images_and_save'](
+            image_folder, out('progress_image.txt'), out('image.jsonl'), batch='image',
+            scheduler=RateLimitScheduler(base_delay=0.1), metrics=metrics)),
+        ('image_async', n_images, lambda: asyncio.run(image_script['process_images_and_save_async'](
+            image_folder, out('progress_image_async.txt'), out('image_async.jsonl'), batch='image_async',
+            max_in_flight=max_in_flight, scheduler=RateLimitScheduler(base_delay=0.1), metrics=metrics))),
+        ('audio', n_clips, lambda: audio_script['process_audio_files'](
+            clip_folder, out('audio_processed.txt'), backend=whisper, workers=audio_workers,
+            min_speech_ratio=None, marked_file=out('marked_files_index.txt'), manifest=manifest)),
+        ('video', n_clips, lambda: video_script['process_media_files'](
+            clip_folder, out('processed.txt'), out('marked_files_index.txt'), out('video.jsonl'), batch='video',
+            scheduler=RateLimitScheduler(base_delay=0.1), manifest=manifest, metrics=metrics)),
+    ]
+
+    results = []
+    try:
+        for name, n_items, function in stages:
+            result = run_stage(name, n_items, function)
+            results.append(result)
+            print(f"{name}: {result['items_per_sec']} items/s, peak memory {result['peak_memory_mb']} MB")
+    finally:
+        server.shutdown()
+        metrics.close()
+
+    # Latencies and retries per stage from the metrics log
+    summary = summarize(load_metrics(out('metrics.jsonl')), by='batch')
+    for result in results:
+        if result['stage'] in summary:
+            s = summary[result['stage']]
+            result.update({'latency': s['latency'], 'retries': s['retries'], 'errors': s['errors']})
+        elif result['stage'] == 'audio' and whisper.latencies:
+            p50, p95, p99 = np.percentile(whisper.latencies, [50, 95, 99])
+            result['latency'] = {'p50': round(p50, 3), 'p95': round(p95, 3), 'p99': round(p99, 3)}
+
+    baseline = {}
+    if baseline_file is not None:
+        with open(baseline_file, 'r') as f:
+            baseline = {r['stage']: r for r in json.load(f)['results']}
+
+    print(f"\n{'stage':<12}{'items/s':>10}{'p50 s':>9}{'p95 s':>9}{'p99 s':>9}{'retries':>9}{'peak MB':>9}{'vs base':>9}")
+    for r in results:
+        latency = r.get('latency') or {}
+        change = (f"{r['items_per_sec'] / baseline[r['stage']]['items_per_sec'] - 1:+.0%}"
+                  if r['stage'] in baseline else '')
+        print(f"{r['stage']:<12}{r['items_per_sec']:>10}{str(latency.get('p50')):>9}{str(latency.get('p95')):>9}"
+              f"{str(latency.get('p99')):>9}{str(r.get('retries', '')):>9}{r['peak_memory_mb']:>9}{change:>9}")
+    print(f"Mock server: {server.stats['requests']} requests, {server.stats['bytes'] / 1e6:.1f} MB received")
+
+    config = {'n_images': n_images, 'n_clips': n_clips, 'max_in_flight': max_in_flight,
+              'audio_workers': audio_workers, 'median': median, 'sigma': sigma,
+              'rate_429': rate_429, 'rate_500': rate_500}
+    with open(results_file, 'w') as f:
+        json.dump({'config': config, 'results': results}, f, indent=2)
+    return results
+
+
+#%% Parameters
+
+if __name__ == '__main__':
+    # Latency of the mock in seconds (log-normal), and the share of 429 and 500 answers
+    results = run_benchmark(n_images=40, n_clips=20, max_in_flight=8, audio_workers=8,
+                            median=0.2, sigma=0.5, rate_429=0.02, rate_500=0.01,
+                            results_file='benchmark_results.json', baseline_file=None)
@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+"""
+
+Benchmark of adaptive frame sampling against the fixed frame times
+
+Rates a sample of videos with the frames at the fixed times of
+Video2img.frame_seconds (the baseline) and with the frames chosen by
+Video2img.adaptive_frame_seconds, with the prompt of the video experiment,
+and reports the frames and image tokens per clip, the token savings and the
+agreement of the ratings with the baseline (retest as in benchmark_harness).
+
+The frames are decoded and scaled for the detail level in memory
+(frame_pipeline); the transcripts are left out, so only the frames differ.
+
+"""
+import base64
+import io
+import os
+import time
+
+import numpy as np
+from PIL import Image
+
+from benchmark_harness import api_setup, compare_conditions, post_and_parse, print_table, sample_files
+from feature_parser import FeatureParser
+from frame_pipeline import decode_frames
+from rate_limiter import estimate_image_tokens
+from script_loader import load_script
+from Video2img import adaptive_frame_seconds, frame_seconds, get_video_duration, mp4_info
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+#%% Benchmark
+
+def clip_duration(video_path):
+    duration, _ = mp4_info(video_path)
+    return duration if duration is not None else get_video_duration(video_path)
+
+def rate_clips(video_paths, sampler, build_payload, detail, pool, scheduler, headers, label):
+    """ Ratings (clips x features) of the videos with the frames chosen by sampler, and the use per clip. """
+    parser = FeatureParser()
+    ratings = np.full((len(video_paths), len(parser.features)), np.nan, dtype=np.float32)
+    use = {'frames': 0, 'image_tokens': 0, 'prompt_tokens': 0, 'seconds': 0.0}
+    for n, video_path in enumerate(video_paths):
+        start_time = time.time()
+        frames = decode_frames(video_path, sampler(video_path, clip_duration(video_path)), detail)
+        use['seconds'] += time.time() - start_time
+        image_contents = []
+        for frame in frames:
+            width, height = Image.open(io.BytesIO(frame)).size
+            use['image_tokens'] += estimate_image_tokens(width, height, detail)
+            url = f"data:image/jpeg;base64,{base64.b64encode(frame).decode('utf-8')}"
+            image_contents.append({"type": "image_url", "image_url": {"url": url, "detail": detail}})
+        use['frames'] += len(frames)
+
+        response = post_and_parse(build_payload(image_contents, []), ratings[n], parser, pool, scheduler, headers,
+                                  label=f"{label} {os.path.basename(video_path)}")
+        use['prompt_tokens'] += response.get('usage', {}).get('prompt_tokens', 0)
+    return ratings, {
+        'frames_per_clip': round(use['frames'] / len(video_paths), 2),
+        'image_tokens_per_clip': round(use['image_tokens'] / len(video_paths), 1),
+        'prompt_tokens_per_clip': round(use['prompt_tokens'] / len(video_paths), 1),
+        'sampling_seconds_per_clip': round(use['seconds'] / len(video_paths), 3),
+    }
+
+def run_benchmark(video_folder, sample_size=20, detail='high', max_frames=4, token_budget=None, retest=True, seed=0):
+    headers, pool, scheduler = api_setup()
+    build_payload = load_script(os.path.join(HERE, 'GPT-4V_video_perception_experiment.py'))['build_payload']
+    paths = sample_files(video_folder, '.mp4', sample_size, seed)
+
+    def fixed(video_path, duration):
+        return frame_seconds(duration)
+
+    def adaptive(video_path, duration):
+        return adaptive_frame_seconds(video_path, duration, max_frames, token_budget, detail)
+
+    def rate_condition(sampler):
+        return rate_clips(paths, sampler, build_payload, detail, pool, scheduler, headers, sampler.__name__)
+
+    results = compare_conditions([('fixed', fixed), ('adaptive', adaptive)], rate_condition, retest)
+    results['adaptive']['image_token_savings'] = round(
+        1 - results['adaptive']['image_tokens_per_clip'] / max(results['fixed']['image_tokens_per_clip'], 1), 3)
+    print_table(results, ['frames_per_clip', 'image_tokens_per_clip', 'image_token_savings'])
+    return results
+
+
+#%% Parameters
+# Folder of the source videos (.mp4)
+video_folder = 'YOUR_SOURCE_FOLDER'
+
+results = run_benchmark(video_folder, sample_size=20, detail='high', max_frames=4, token_budget=1500, retest=True)
@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+"""
+
+Shared harness of the rating benchmarks
+
+The benchmarks rate the same random sample once per condition (the first
+condition is the baseline of the experiment) and compare the ratings with
+the baseline. With retest=True the baseline is rated a second time: the
+agreement of GPT with itself is the level the other conditions should be
+compared against, so a condition that stays close to it costs little
+fidelity.
+
+"""
+import os
+import random
+import time
+
+import numpy as np
+
+from api_client import post_with_backoff
+from connection_pool import ConnectionPool
+from feature_parser import rating_agreement
+from output_records import response_content
+from rate_limiter import RateLimitScheduler
+
+def api_setup():
+    """ Headers, connection pool and scheduler of a benchmark run. """
+    headers = {
+        # set the key here
+        'Authorization': 'Bearer YOUR-API-KEY',
+        'Content-Type': 'application/json'
+    }
+    return headers, ConnectionPool(max_idle=1), RateLimitScheduler()
+
+def sample_files(folder_path, extensions, sample_size, seed=0):
+    """ Paths of a reproducible random sample of the files of a folder. """
+    files = sorted(f for f in os.listdir(folder_path) if f.lower().endswith(extensions))
+    sample = random.Random(seed).sample(files, min(sample_size, len(files)))
+    return [os.path.join(folder_path, f) for f in sample]
+
+def post_and_parse(payload, row, parser, pool, scheduler, headers, label=''):
+    """ Send one rating request and parse its answer into row; returns the response ({} when it failed). """
+    response = post_with_backoff(pool, payload, headers, scheduler, label=label) or {}
+    content = response_content(response)
+    if content is not None and 'error' not in response:
+        parser.parse_into(content, row)
+    return response
+
+def compare_conditions(conditions, rate, retest=True):
+    """ Rate the sample under every condition and compare the ratings with the first one.
+
+    conditions is a list of (name, condition); rate(condition) returns the
+    ratings (items x features) and a dict of what the condition used. The
+    result of every condition is that dict with the seconds taken, the NaN
+    ratings and the agreement with the baseline; the retest is under 'retest'.
+    """
+    results = {}
+    baseline = None
+    for name, condition in conditions:
+        start_time = time.time()
+        ratings, use = rate(condition)
+        result = {'seconds': round(time.time() - start_time, 1), **use,
+                  'nan_ratings': int(np.isnan(ratings).sum())}
+        if baseline is None:
+            baseline = ratings
+        else:
+            result['agreement'] = rating_agreement(baseline, ratings)
+        results[name] = result
+        print(f"{name}: {result}")
+
+    if retest:
+        repeat, _ = rate(conditions[0][1])
+        results['retest'] = {'agreement': rating_agreement(baseline, repeat)}
+        print(f"{conditions[0][0]} again: {results['retest']}")
+    return results
+
+def print_table(results, columns):
+    """ One line per condition: the given columns of its result and the agreement with the baseline. """
+    widths = [max(12, len(column) + 2) for column in columns]
+    print('\n' + f"{'':>12}" + ''.join(f"{column:>{width}}" for column, width in zip(columns, widths))
+          + f"{'mean r':>9}{'MAE':>8}")
+    for name, result in results.items():
+        agreement = result.get('agreement', {})
+        correlation = agreement.get('mean_correlation', np.nan)
+        difference = agreement.get('mean_abs_difference', np.nan)
+        cells = ''.join(f"{str(result.get(column, '')):>{width}}" for column, width in zip(columns, widths))
+        print(f"{str(name):>12}{cells}{correlation:>9.3f}{difference:>8.2f}")
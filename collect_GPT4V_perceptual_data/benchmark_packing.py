@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+"""
+
+Benchmark of packing several images into one rating request
+
+Rates a random sample of frames one image per request (k = 1, the
+baseline) and with k images per request for every k in ks, all with the
+same model and JSON answer format, and reports for every k the prompt and
+completion tokens per image and the agreement of the ratings with the
+baseline (retest as in benchmark_harness).
+
+"""
+import base64
+import os
+
+import numpy as np
+
+from api_client import post_with_backoff
+from benchmark_harness import api_setup, compare_conditions, print_table, sample_files
+from feature_parser import FeatureParser
+from item_packing import build_packed_payload, split_packed_response
+from output_records import response_content
+from rating_prompts import IMAGE_PROMPT
+
+#%% Benchmark
+
+def rate_packed(paths, k, model, detail, pool, scheduler, headers):
+    """ Ratings (images x features) of the images rated k per request, and the token use per image. """
+    parser = FeatureParser()
+    ratings = np.full((len(paths), len(parser.features)), np.nan, dtype=np.float32)
+    tokens = {'prompt_tokens': 0, 'completion_tokens': 0, 'requests': 0, 'missing': 0}
+    ids = [os.path.basename(path) for path in paths]
+    for start in range(0, len(paths), k):
+        image_urls = {}
+        for image_id, path in zip(ids[start:start + k], paths[start:start + k]):
+            with open(path, 'rb') as f:
+                image_urls[image_id] = f"data:image/png;base64,{base64.b64encode(f.read()).decode('utf-8')}"
+        payload = build_packed_payload(image_urls, IMAGE_PROMPT, detail, model)
+        response = post_with_backoff(pool, payload, headers, scheduler, label=f"k={k} #{start}") or {}
+        tokens['requests'] += 1
+        tokens['prompt_tokens'] += response.get('usage', {}).get('prompt_tokens', 0)
+        tokens['completion_tokens'] += response.get('usage', {}).get('completion_tokens', 0)
+        for n, (image_id, single) in enumerate(split_packed_response(response, list(image_urls)).items()):
+            if single is None:
+                tokens['missing'] += 1
+                continue
+            parser.parse_into(response_content(single), ratings[start + n])
+    return ratings, {
+        'requests': tokens['requests'],
+        'prompt_tokens_per_image': round(tokens['prompt_tokens'] / len(paths), 1),
+        'completion_tokens_per_image': round(tokens['completion_tokens'] / len(paths), 1),
+        'missing_images': tokens['missing'],
+    }
+
+def run_benchmark(folder_path, ks=(2, 4, 8), sample_size=24, model='gpt-4o-2024-08-06', detail='auto',
+                  retest=True, seed=0):
+    headers, pool, scheduler = api_setup()
+    paths = sample_files(folder_path, '.png', sample_size, seed)
+
+    def rate_condition(k):
+        return rate_packed(paths, k, model, detail, pool, scheduler, headers)
+
+    results = compare_conditions([(k, k) for k in (1, *ks)], rate_condition, retest)
+    print_table(results, ['requests', 'prompt_tokens_per_image', 'completion_tokens_per_image'])
+    return results
+
+
+#%% Parameters
+# Folder of frames (PNG) to sample from
+folder_path = "YOUR-FOLDER-PATH"
+
+results = run_benchmark(folder_path, ks=(2, 4, 8), sample_size=24, model='gpt-4o-2024-08-06', retest=True)
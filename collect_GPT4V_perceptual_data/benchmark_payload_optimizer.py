@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+"""
+
+Benchmark of the image payload optimizer
+
+Rates a random sample of frames twice, once as the original PNG (the
+baseline of the image experiment) and once resized and re-encoded by the
+PayloadOptimizer, and reports the upload bytes and tokens saved together
+with the agreement between the two sets of ratings (retest as in
+benchmark_harness).
+
+"""
+import base64
+
+import numpy as np
+
+from benchmark_harness import api_setup, compare_conditions, post_and_parse, print_table, sample_files
+from feature_parser import FeatureParser
+from payload_optimizer import PayloadOptimizer
+from rating_prompts import IMAGE_PROMPT, rating_messages
+
+#%% Benchmark
+
+def image_payload(image_url, detail, model="gpt-4-vision-preview"):
+    return {
+        "model": model,
+        "messages": rating_messages(IMAGE_PROMPT, [
+            {"type": "image_url", "image_url": {"url": image_url, "detail": detail}},
+        ]),
+        "max_tokens": 4096,
+    }
+
+def rate(image_urls, detail, pool, scheduler, headers):
+    parser = FeatureParser()
+    ratings = np.full((len(image_urls), len(parser.features)), np.nan, dtype=np.float32)
+    use = {'upload_mb': round(sum(map(len, image_urls)) / 1e6, 1), 'prompt_tokens': 0}
+    for n, image_url in enumerate(image_urls):
+        response = post_and_parse(image_payload(image_url, detail), ratings[n], parser, pool, scheduler, headers,
+                                  label=str(n))
+        use['prompt_tokens'] += response.get('usage', {}).get('prompt_tokens', 0)
+    return ratings, use
+
+def run_benchmark(folder_path, optimizer, sample_size=30, retest=False, seed=0):
+    headers, pool, scheduler = api_setup()
+    paths = sample_files(folder_path, '.png', sample_size, seed)
+
+    baseline_urls = []
+    for path in paths:
+        with open(path, 'rb') as f:
+            baseline_urls.append(f"data:image/png;base64,{base64.b64encode(f.read()).decode('utf-8')}")
+    optimized_urls = [optimizer.data_url(path) for path in paths]
+
+    def rate_condition(condition):
+        image_urls, detail = condition
+        return rate(image_urls, detail, pool, scheduler, headers)
+
+    conditions = [('baseline', (baseline_urls, 'auto')), ('optimized', (optimized_urls, optimizer.detail))]
+    results = compare_conditions(conditions, rate_condition, retest)
+    results['optimized']['optimizer'] = optimizer.summary()
+    print_table(results, ['upload_mb', 'prompt_tokens', 'nan_ratings'])
+    return results
+
+
+#%% Parameters
+# Folder of frames (PNG) to sample from
+folder_path = "YOUR-FOLDER-PATH"
+
+optimizer = PayloadOptimizer(detail='high', image_format='JPEG', quality=85)
+
+results = run_benchmark(folder_path, optimizer, sample_size=30, retest=True)
@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+"""
+
+Manifest of the clip folder tree
+
+One scan with os.scandir over the folder of clips (one subfolder per video,
+as written by Video2img) records for every clip:
+
+frames       frame_<second>s.png/.jpg, sorted by their timestamp
+audio        .mp3 files
+transcripts  .txt files
+
+with the size, mtime and a content hash (BLAKE2b) of each file, in one
+compact JSON file. The experiment stages read the clips from the manifest
+instead of listing the folders again. Building it again is incremental:
+the folders are re-scanned, but only new or changed files (other size or
+mtime) are hashed again.
+
+"""
+import hashlib
+import json
+import os
+import re
+import tempfile
+
+FRAME_REGEX = re.compile(r'^frame_(\d+(?:\.\d+)?)s\.(?:png|jpe?g)$', re.IGNORECASE)
+
+def file_hash(file_path, chunk_size=1 << 20):
+    digest = hashlib.blake2b(digest_size=16)
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def _file_entry(dir_entry, previous, hash_files):
+    stat = dir_entry.stat()
+    entry = {'name': dir_entry.name, 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+    if previous and previous['size'] == entry['size'] and previous['mtime_ns'] == entry['mtime_ns']:
+        entry['hash'] = previous.get('hash')  # unchanged, keep the hash
+    elif hash_files:
+        entry['hash'] = file_hash(dir_entry.path)
+    return entry
+
+def scan_clip(clip_path, previous=None, hash_files=True):
+    """ Frames, audio and transcripts of one clip folder. """
+    old = {}
+    for kind in ('frames', 'audio', 'transcripts'):
+        for entry in (previous or {}).get(kind, []):
+            old[entry['name']] = entry
+
+    clip = {'frames': [], 'audio': [], 'transcripts': []}
+    with os.scandir(clip_path) as entries:
+        for dir_entry in entries:
+            if not dir_entry.is_file():
+                continue
+            name = dir_entry.name
+            lower = name.lower()
+            match = FRAME_REGEX.match(name)
+            if match:
+                entry = _file_entry(dir_entry, old.get(name), hash_files)
+                entry['second'] = float(match.group(1))
+                clip['frames'].append(entry)
+            elif lower.endswith(('.png', '.jpg', '.jpeg')):
+                # Frames named otherwise go after the timed ones, by name
+                entry = _file_entry(dir_entry, old.get(name), hash_files)
+                entry['second'] = None
+                clip['frames'].append(entry)
+            elif lower.endswith('.mp3'):
+                clip['audio'].append(_file_entry(dir_entry, old.get(name), hash_files))
+            elif lower.endswith('.txt'):
+                clip['transcripts'].append(_file_entry(dir_entry, old.get(name), hash_files))
+
+    clip['frames'].sort(key=lambda e: (e['second'] is None, e['second'] or 0, e['name']))
+    clip['audio'].sort(key=lambda e: e['name'])
+    clip['transcripts'].sort(key=lambda e: e['name'])
+    return clip
+
+def build_manifest(folder_path, manifest_file='manifest.json', hash_files=True):
+    """ Scan the clip folders and save the manifest; unchanged files keep their hashes. """
+    previous = load_manifest(manifest_file)
+    if previous is None or previous['root'] != os.path.abspath(folder_path):
+        previous = {'clips': {}}
+
+    clips = {}
+    with os.scandir(folder_path) as entries:
+        for dir_entry in entries:
+            if dir_entry.is_dir():
+                clips[dir_entry.name] = scan_clip(dir_entry.path, previous['clips'].get(dir_entry.name), hash_files)
+
+    manifest = {'root': os.path.abspath(folder_path), 'clips': dict(sorted(clips.items()))}
+    save_manifest(manifest, manifest_file)
+    return manifest
+
+def load_manifest(manifest_file='manifest.json'):
+    try:
+        with open(manifest_file, 'r', encoding='utf-8') as f:
+            manifest = json.load(f)
+    except FileNotFoundError:
+        return None
+    manifest['file'] = manifest_file
+    return manifest
+
+def save_manifest(manifest, manifest_file=None):
+    manifest_file = manifest_file or manifest['file']
+    data = {'root': manifest['root'], 'clips': manifest['clips']}
+    # Write a new file and swap it in, so a crash never leaves half a manifest; the temporary
+    # file has its own name, so processes saving at the same time do not take each other's file
+    with tempfile.NamedTemporaryFile('w', encoding='utf-8', dir=os.path.dirname(os.path.abspath(manifest_file)),
+                                     prefix=os.path.basename(manifest_file) + '.', suffix='.tmp',
+                                     delete=False) as f:
+        json.dump(data, f, ensure_ascii=False, separators=(',', ':'))
+    try:
+        os.replace(f.name, manifest_file)
+    except OSError:
+        os.remove(f.name)
+        raise
+    manifest['file'] = manifest_file
+
+def clip_path(manifest, clip_name, file_name=''):
+    return os.path.join(manifest['root'], clip_name, file_name)
+
+def clip_files(manifest, clip_name, kind):
+    """ Full paths of the frames, audio or transcripts of a clip (frames in temporal order). """
+    return [clip_path(manifest, clip_name, entry['name']) for entry in manifest['clips'][clip_name][kind]]
+
+def update_clip(manifest, clip_name, hash_files=True):
+    """ Re-scan one clip folder after a stage has written files into it. """
+    manifest['clips'][clip_name] = scan_clip(clip_path(manifest, clip_name),
+                                             manifest['clips'].get(clip_name), hash_files)
@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+"""
+
+Keep-alive connection pool for the GPT API
+
+Connections are reused across requests instead of opening a new one (and
+paying a new TCP + TLS handshake) for every image or video. A connection is
+dropped after an error, when the server asks to close it or when it has been
+idle too long, and at most max_idle sockets are kept open.
+
+"""
+import threading
+import time
+
+from api_client import API_BASE_URL, make_connection
+
+
+class ConnectionPool:
+
+    def __init__(self, base_url=API_BASE_URL, max_idle=4, idle_timeout=30.0):
+        self.base_url = base_url
+        self.max_idle = max_idle
+        self.idle_timeout = idle_timeout
+        self.idle = []  # (connection, time released)
+        self.lock = threading.Lock()
+        self.handshakes = 0
+        self.requests = 0
+        self.recycled = 0
+
+    def _new_connection(self):
+        conn = make_connection(self.base_url)
+        connect = conn.connect
+
+        # Count every real handshake, including reconnects done by http.client
+        def counting_connect():
+            with self.lock:
+                self.handshakes += 1
+            connect()
+
+        conn.connect = counting_connect
+        return conn
+
+    def acquire(self):
+        """ Take an idle connection, or open a new one if none is left. """
+        with self.lock:
+            self.requests += 1
+            now = time.monotonic()
+            while self.idle:
+                conn, released = self.idle.pop()
+                if now - released < self.idle_timeout:
+                    return conn
+                conn.close()
+        return self._new_connection()
+
+    def release(self, conn, broken=False):
+        """ Give a connection back after its response has been read completely. """
+        with self.lock:
+            if broken:
+                self.recycled += 1
+            if broken or len(self.idle) >= self.max_idle:
+                conn.close()
+                return
+            self.idle.append((conn, time.monotonic()))
+
+    def close(self):
+        with self.lock:
+            for conn, _ in self.idle:
+                conn.close()
+            self.idle = []
+
+    def stats(self):
+        with self.lock:
+            return {'requests': self.requests, 'handshakes': self.handshakes,
+                    'recycled': self.recycled, 'idle': len(self.idle)}
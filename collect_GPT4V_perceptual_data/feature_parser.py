@@ -0,0 +1,170 @@
+# -*- coding: utf-8 -*-
+"""
+
+Parse the "Feature: score" answers of GPT into a fixed items x 138 matrix
+
+The feature list is loaded once and every response line is mapped to the
+column of its feature, so the columns are always in the same order and
+misspelt feature names do not turn into stray columns. Names that do not
+match a feature exactly are resolved through the known aliases and then by
+fuzzy matching; lines that still cannot be placed are counted for a report.
+Fuzzy matching also accepts near-opposites and misspellings (e.g. "Feeling
+unsecure" for Feeling insecure), so every name placed that way is counted
+too and listed in the report for checking.
+
+Answers in the JSON format of structured_output.py are decoded straight into
+the row; when their keys are the features in order (as the schema asks), the
+values are copied in one step without looking up any name.
+
+"""
+import difflib
+import json
+import re
+from collections import Counter
+
+import numpy as np
+
+from feature_schema import ALIASES, FEATURES, normalize_name
+from structured_output import is_json_answer
+
+# A score, whole or decimal (e.g. 3.5)
+SCORE_REGEX = re.compile(r'\d+(?:\.\d+)?')
+
+# "Feature score" lines with any separator, and an optional note in brackets
+LINE_REGEX = re.compile(r'^(.+?)[\t\|\:,\s]+\s*(\d+(?:\.\d+)?)\s*(?:\(\s*[^)]*\))?\s*$')
+
+# "Feature": score pairs of a JSON answer that is not complete
+JSON_PAIR_REGEX = re.compile(r'"([^"]+)"\s*:\s*(\d+(?:\.\d+)?)\s*[,}]')
+
+
+class FeatureParser:
+
+    def __init__(self, features=FEATURES, aliases=ALIASES, fuzzy_cutoff=0.85):
+        self.features = list(features)
+        self.columns = {normalize_name(name): i for i, name in enumerate(self.features)}
+        for alias, name in aliases.items():
+            self.columns[normalize_name(alias)] = self.columns[normalize_name(name)]
+        self.fuzzy_cutoff = fuzzy_cutoff
+        self.resolved = {}  # raw name -> column or None, filled as names are seen
+        self.fuzzy_names = set()  # raw names resolved by fuzzy matching
+        self.unmatched = Counter()
+        self.fuzzy = Counter()  # (raw name, feature) -> times placed by fuzzy matching
+
+    def column(self, name):
+        """ Column index of a feature name, or None if it matches no feature. """
+        if name in self.resolved:
+            col = self.resolved[name]
+        else:
+            key = normalize_name(name)
+            col = self.columns.get(key)
+            if col is None:
+                close = difflib.get_close_matches(key, self.columns, n=1, cutoff=self.fuzzy_cutoff)
+                if close:
+                    col = self.columns[close[0]]
+                    self.fuzzy_names.add(name)
+            self.resolved[name] = col
+        if name in self.fuzzy_names:
+            self.fuzzy[name, self.features[col]] += 1
+        return col
+
+    def parse_json_into(self, ratings, row):
+        """ Write a decoded JSON answer ({feature: score}) into row. """
+        values = list(ratings.values())
+        if list(ratings) == self.features and all(type(v) is int for v in values):
+            row[:] = values
+            return len(values)
+
+        matched = 0
+        for name, value in ratings.items():
+            col = self.column(name)
+            if col is None or not isinstance(value, (int, float)) or isinstance(value, bool):
+                self.unmatched[f"{name}: {value}"] += 1
+                continue
+            row[col] = float(value)
+            matched += 1
+        return matched
+
+    def parse_into(self, content, row):
+        """ Write the scores of one response into row (features not given stay NaN). """
+        if content.strip().startswith("{I'm sorry}"):
+            return 0
+
+        if is_json_answer(content):
+            try:
+                ratings = json.loads(content)
+            except ValueError:
+                # e.g. cut off at max_tokens: keep the pairs before the cut
+                ratings = {name: float(value) for name, value in JSON_PAIR_REGEX.findall(content)}
+            if isinstance(ratings, dict):
+                return self.parse_json_into(ratings, row)
+
+        matched = 0
+        for line in content.split('\n'):
+            line = line.strip()
+            if not line:
+                continue
+            # Most lines are "Feature: score", which needs no regex
+            name, sep, value = line.rpartition(':')
+            value = value.strip()
+            if not (sep and SCORE_REGEX.fullmatch(value)):
+                match = LINE_REGEX.match(line)
+                if not match:
+                    self.unmatched[line] += 1
+                    continue
+                name, value = match.groups()
+            col = self.column(name.strip())
+            if col is None:
+                self.unmatched[line] += 1
+                continue
+            row[col] = float(value)
+            matched += 1
+        return matched
+
+    def parse_all(self, contents):
+        """ Parse an iterable of responses into a float32 matrix (items x features). """
+        size = len(contents) if hasattr(contents, '__len__') else 1024
+        matrix = np.full((size, len(self.features)), np.nan, dtype=np.float32)
+        n = 0
+        for content in contents:
+            if n == len(matrix):
+                # Streamed input of unknown length: grow by doubling
+                grown = np.full((2 * len(matrix), len(self.features)), np.nan, dtype=np.float32)
+                grown[:n] = matrix
+                matrix = grown
+            self.parse_into(content, matrix[n])
+            n += 1
+        return matrix[:n]
+
+    def report(self, top=20):
+        """ The most common response lines that could not be matched to a feature, and all fuzzy matches. """
+        total = sum(self.unmatched.values())
+        print(f"{total} unmatched lines, {len(self.unmatched)} distinct.")
+        for line, count in self.unmatched.most_common(top):
+            print(f"{count:6d}  {line}")
+        # Every name placed by fuzzy matching, so a wrong mapping can be spotted and added to ALIASES or fixed
+        print(f"{sum(self.fuzzy.values())} ratings placed by fuzzy matching, {len(self.fuzzy)} distinct names.")
+        for (name, feature), count in self.fuzzy.most_common():
+            print(f"{count:6d}  {name} -> {feature}")
+        return self.unmatched
+
+def rating_agreement(ratings_a, ratings_b):
+    """ Agreement of two rating matrices of the same items (items x features).
+
+    Returns the mean over features of the Pearson correlation across items,
+    the mean absolute difference and the share of identical ratings.
+    Features without variation in either matrix are left out of the correlation.
+    """
+    a = np.asarray(ratings_a, dtype=np.float64)
+    b = np.asarray(ratings_b, dtype=np.float64)
+    both = ~(np.isnan(a) | np.isnan(b))
+    correlations = []
+    for col in range(a.shape[1]):
+        x, y = a[both[:, col], col], b[both[:, col], col]
+        if len(x) > 2 and x.std() > 0 and y.std() > 0:
+            correlations.append(np.corrcoef(x, y)[0, 1])
+    return {
+        'mean_correlation': float(np.mean(correlations)) if correlations else np.nan,
+        'features_correlated': len(correlations),
+        'mean_abs_difference': float(np.abs(a - b)[both].mean()) if both.any() else np.nan,
+        'identical': float((a == b)[both].mean()) if both.any() else np.nan,
+    }
@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+"""
+
+The 138 social features rated in the image and video experiments
+
+FEATURES holds the canonical names in the order of the prompts; their index
+is the column of a feature in every ratings matrix. ALIASES maps known
+misspellings and variants seen in prompts and responses to a canonical name.
+
+"""
+import re
+
+FEATURES = [
+    "Dominant", "Unpleasant", "Trustworthy", "Warm", "Competent", "Agentic", "Experienced",
+    "Open", "Conscientious", "Neurotic", "Extravert", "Kind", "Honest", "Creative", "Lazy",
+    "Loyal", "Stubborn", "Shy", "Intelligent", "Socially competent", "Brave", "Selfish",
+    "Successful", "Ambitious", "Impulsive", "Punctual", "Immoral", "Submissive",
+    "Pleasant", "Introvert", "Agreeable", "Nude", "Old", "Attractive", "Masculine",
+    "Feminine", "In poor somatic health", "In poor mental health", "Alone",
+    "Eating / drinking", "Sweating / feeling hot", "Coughing / sneezing",
+    "Vomiting / urinating / defecating", "Feeling ill", "Feeling nauseous / dizzy",
+    "Feeling energetic", "Feeling tired", "Moving their body", "Moving their leg / foot",
+    "Moving their arm / hand", "Moving their head", "Making facial expressions",
+    "Moving reflexively", "Jumping", "Sitting", "Standing", "Laying down",
+    "Moving rapidly", "Moving towards someone", "Moving away from someone",
+    "Panting / short of breath", "Smelling something", "Feeling pain",
+    "Listening to something", "Tasting something", "Looking at something", "Feeling touch",
+    "Blinking", "Hungry / thirsty", "Moaning / groaning", "Yelling", "Touching someone",
+    "Crying", "Making gaze contact", "Hitting / hurting someone", "Laughing", "Talking",
+    "Kissing / hugging / cuddling", "Whispering", "Communicating nonverbally",
+    "Attending someone", "Ignoring someone", "Gesturing", "Showing affection",
+    "Being morally righteous", "Thinking / reasoning", "Empathizing", "Feeling secure",
+    "Feeling confident", "Daydreaming", "Wanting something", "Feeling satisfied",
+    "Feeling calm", "Exerting self-control", "Feeling displeasure", "Experiencing failure",
+    "Making a decision", "Pursuing a goal", "Feeling lonely", "Feeling moved",
+    "Exerting mental effort", "Sexually aroused", "Focusing attention",
+    "Experiencing success", "Feeling insecure", "Feeling pleasure", "Feeling disappointed",
+    "Feeling agitated", "Motivated", "Physically aggressive", "Intimate", "Informal",
+    "Romantic", "Compliant", "Interacting positively", "Joking", "Authoritarian",
+    "Acting reluctantly", "Hostile", "Cooperative", "Flirtatious", "Harassing someone",
+    "Interacting physically", "Emotionally aroused", "Verbally aggressive", "Equal",
+    "Affectionate", "Serious", "Playful", "Superficial", "Interacting negatively",
+    "Formal", "Having a conflict", "Sexual", "Acting voluntarily",
+    "Interacting emotionally", "Making fun of someone", "Inequal"
+]
+
+ALIASES = {
+    # Typo in the earlier prompt of the image experiment, found in its archived outputs
+    "Intreracting negatively": "Interacting negatively",
+    "Unequal": "Inequal",
+    "Lying down": "Laying down",
+}
+
+def normalize_name(name):
+    """ Lower-case key of a feature name, ignoring markup, numbering and spacing. """
+    name = re.sub(r'^[\s\-\*\d\.\)]+', '', name)  # list markers such as "- ", "12. "
+    name = name.replace('*', '').replace('_', ' ')
+    name = re.sub(r'\s*/\s*', ' / ', name)
+    return re.sub(r'\s+', ' ', name).strip().lower()
@@ -0,0 +1,155 @@
+# -*- coding: utf-8 -*-
+"""
+
+Deduplication of identical and near-identical frames before they are sent
+
+The frame sets hold many frames that are (almost) the same picture:
+consecutive frames of static shots, or the same frame saved twice. The
+FrameDeduplicator hashes all the frames of a folder in parallel and groups
+them into clusters, each rated once through its representative (the first
+frame of the cluster by name); the experiment then writes the rating of the
+representative for every other frame of the cluster, with "duplicate_of"
+in the response.
+
+mode='exact'   only frames with identical pixels (digest of the decoded image)
+mode='near'    also frames whose difference hash (dHash, 64 bits) differs in
+               at most threshold bits from the representative; the
+               representatives are kept in a BK-tree, so every frame is
+               compared with only a few of them
+
+A threshold of about 5 of 64 bits groups re-encoded and slightly shifted
+copies of a frame; check a sample of the clusters (clusters()) before
+using larger thresholds.
+
+Ref: https://www.hackerfactor.com/blog/index.php?/archives/529-Kind-of-Like-That.html
+
+"""
+import hashlib
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from PIL import Image
+
+#%% Hashing
+
+def image_hashes(image_path, hash_size=8):
+    """ Digest of the decoded pixels and the difference hash of an image. """
+    with Image.open(image_path) as image:
+        image = image.convert('RGB')
+        digest = hashlib.blake2b(image.tobytes(), digest_size=16)
+        digest.update(f"{image.size}".encode())
+        # Brightness gradient between neighbouring pixels of a (hash_size + 1) x hash_size thumbnail
+        small = image.convert('L').resize((hash_size + 1, hash_size), Image.LANCZOS)
+    pixels = list(small.getdata())
+    bits = 0
+    for row in range(hash_size):
+        for col in range(hash_size):
+            left = pixels[row * (hash_size + 1) + col]
+            bits = (bits << 1) | (left > pixels[row * (hash_size + 1) + col + 1])
+    return digest.hexdigest(), bits
+
+def hamming(a, b):
+    return bin(a ^ b).count('1')
+
+
+class BKTree:
+    """ Burkhard-Keller tree of hashes under the Hamming distance. """
+
+    def __init__(self):
+        self.root = None  # [hash, item, {distance: child}]
+
+    def add(self, bits, item):
+        if self.root is None:
+            self.root = [bits, item, {}]
+            return
+        node = self.root
+        while True:
+            distance = hamming(bits, node[0])
+            child = node[2].get(distance)
+            if child is None:
+                node[2][distance] = [bits, item, {}]
+                return
+            node = child
+
+    def search(self, bits, max_distance):
+        """ (distance, item) of all hashes within max_distance, nearest first. """
+        found = []
+        nodes = [self.root] if self.root is not None else []
+        while nodes:
+            node = nodes.pop()
+            distance = hamming(bits, node[0])
+            if distance <= max_distance:
+                found.append((distance, node[1]))
+            # By the triangle inequality only these subtrees can hold matches
+            nodes.extend(child for d, child in node[2].items() if abs(d - distance) <= max_distance)
+        return sorted(found, key=lambda match: match[0])
+
+#%% Deduplication
+
+class FrameDeduplicator:
+
+    def __init__(self, mode='near', threshold=5, hash_size=8, workers=None):
+        if mode not in ('exact', 'near'):
+            raise ValueError(f"Unknown mode {mode!r}, use 'exact' or 'near'")
+        self.mode = mode
+        self.threshold = threshold
+        self.hash_size = hash_size
+        self.workers = workers or os.cpu_count()
+        self.representative = {}  # frame -> representative of its cluster
+        self.members = {}  # representative -> the other frames of its cluster
+
+    def _hashes(self, image_path):
+        try:
+            return image_hashes(image_path, self.hash_size)
+        except Exception as e:
+            # An unreadable frame stays on its own; sending it reports the error
+            print(f"Cannot hash {os.path.basename(image_path)}: {e}")
+            return None
+
+    def plan(self, folder_path, filenames):
+        """ Group the frames; returns {frame: representative} for the frames that need no request. """
+        filenames = sorted(filenames)
+        # Decoding and resizing in PIL release the GIL, so threads use all the cores
+        with ThreadPoolExecutor(self.workers) as executor:
+            hashes = list(executor.map(lambda name: self._hashes(os.path.join(folder_path, name)), filenames))
+
+        self.representative = {}
+        self.members = {}
+        by_digest = {}
+        tree = BKTree()
+        for filename, frame_hashes in zip(filenames, hashes):
+            if frame_hashes is None:
+                self.representative[filename] = filename
+                continue
+            digest, bits = frame_hashes
+            representative = by_digest.get(digest)
+            if representative is None and self.mode == 'near':
+                matches = tree.search(bits, self.threshold)
+                if matches:
+                    representative = matches[0][1]
+            if representative is None:
+                # A new cluster
+                representative = filename
+                by_digest[digest] = filename
+                tree.add(bits, filename)
+            self.representative[filename] = representative
+            if representative != filename:
+                self.members.setdefault(representative, []).append(filename)
+        return {frame: rep for frame, rep in self.representative.items() if frame != rep}
+
+    def duplicates(self, representative):
+        """ The other frames of the cluster of a representative. """
+        return self.members.get(representative, [])
+
+    def clusters(self):
+        """ {representative: [frames]} of the clusters with more than one frame. """
+        return {rep: [rep, *frames] for rep, frames in self.members.items()}
+
+    def summary(self):
+        frames = len(self.representative)
+        requests = len(set(self.representative.values()))
+        saved = frames - requests
+        share = saved / frames if frames else 0.0
+        setting = f"near, threshold {self.threshold}" if self.mode == 'near' else 'exact'
+        print(f"Dedup ({setting}): {frames} frames in {requests} clusters, {saved} requests saved ({share:.1%}).")
+        return {'frames': frames, 'requests': requests, 'saved': saved}
@@ -0,0 +1,135 @@
+# -*- coding: utf-8 -*-
+"""
+
+In-memory frame pipeline for the video experiment
+
+Decodes the sampled frames of a video through an ffmpeg pipe, scales them
+to the image detail level of the API and encodes them as JPEG (or PNG) in
+the same ffmpeg run, and yields ready-to-send base64 data URLs. Nothing has
+to be written to disk and read back; saving the frames is an optional
+cache step.
+
+Ref: https://platform.openai.com/docs/guides/vision
+
+"""
+import base64
+import os
+import struct
+import subprocess
+
+from Video2img import frame_seconds, get_video_duration, mp4_info
+
+# Largest frame the API looks at for each detail level
+SCALE_FILTERS = {
+    'low': "scale=w='trunc(iw*min(1,512/max(iw,ih))/2)*2':h=-2",
+    'high': "scale=w='trunc(iw*min(1,min(768/min(iw,ih),2048/max(iw,ih)))/2)*2':h=-2",
+    'original': None,
+}
+# With detail 'auto' (the API default) the model may look at the frame in high detail
+SCALE_FILTERS['auto'] = SCALE_FILTERS['high']
+
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+
+def _split_jpeg(data):
+    # Every frame ends with the EOI marker; 0xFF bytes inside the image data are stuffed
+    frames = []
+    start = 0
+    while start < len(data):
+        end = data.find(b'\xff\xd9', start)
+        if end < 0:
+            break
+        frames.append(data[start:end + 2])
+        start = end + 2
+    return frames
+
+def _split_png(data):
+    # Walk the chunks by their length fields (length, type, data, CRC) up to the IEND of each frame;
+    # the bytes IEND can also turn up inside the compressed image data
+    frames = []
+    start = 0
+    while data.startswith(PNG_SIGNATURE, start):
+        position = start + len(PNG_SIGNATURE)
+        while position + 8 <= len(data):
+            length, chunk_type = struct.unpack('>I4s', data[position:position + 8])
+            position += 12 + length
+            if chunk_type == b'IEND':
+                frames.append(data[start:position])
+                break
+        else:
+            break  # cut off
+        start = position
+    return frames
+
+def decode_frames(video_path, seconds, detail='high', image_format='jpeg', quality=4):
+    """ Return the encoded frames at the given seconds, decoded in one ffmpeg run.
+
+    Each frame is the first one at or after its time, like Video2img.
+    quality is the JPEG qscale (2 = best, 31 = worst). Raises RuntimeError
+    when ffmpeg does not return one frame per time (a time past the end of
+    the video, or two times within one frame interval), as the frames could
+    not be matched to their times.
+    """
+    if detail not in SCALE_FILTERS:
+        raise ValueError(f"Unknown detail {detail!r}, use one of {sorted(SCALE_FILTERS)}")
+    # Pick the first frame at or after each time
+    terms = [f"gte(t,{second:.3f})*(isnan(prev_selected_t)+lt(prev_selected_t,{second:.3f}))"
+             for second in sorted(seconds)]
+    filters = [f"select='{'+'.join(terms)}'"]
+    if SCALE_FILTERS[detail]:
+        filters.append(SCALE_FILTERS[detail])
+
+    command = ['ffmpeg', '-v', 'error', '-threads', '1', '-i', video_path, '-map', '0:v:0',
+               '-vf', ','.join(filters), '-fps_mode', 'passthrough', '-frames:v', str(len(seconds)),
+               '-f', 'image2pipe']
+    if image_format == 'jpeg':
+        command += ['-c:v', 'mjpeg', '-q:v', str(quality), '-']
+    else:
+        command += ['-c:v', 'png', '-']
+    result = subprocess.run(command, capture_output=True)
+    if result.returncode != 0:
+        raise RuntimeError(f"ffmpeg failed for {video_path}: {result.stderr.decode(errors='replace')[-500:]}")
+    frames = _split_jpeg(result.stdout) if image_format == 'jpeg' else _split_png(result.stdout)
+    if len(frames) != len(seconds):
+        raise RuntimeError(f"ffmpeg returned {len(frames)} frames for the {len(seconds)} times "
+                           f"{[round(second, 3) for second in seconds]} of {video_path}")
+    return frames
+
+def frame_data_urls(video_path, detail='high', image_format='jpeg', quality=4, cache_folder=None, sampler=None):
+    """ Base64 data URLs of the sampled frames of a video, in temporal order.
+
+    Raises RuntimeError for a video that cannot be read or decoded.
+
+    With cache_folder the encoded frames are also saved there
+    (frame_<second>s.jpg as in Video2img) and read from there next time.
+    sampler(video_path, duration) chooses the seconds instead of the fixed
+    times, e.g. Video2img.adaptive_frame_seconds.
+    """
+    try:
+        duration, _ = mp4_info(video_path)
+        if duration is None:
+            duration = get_video_duration(video_path)
+    except (OSError, ValueError, IndexError, struct.error, ZeroDivisionError) as e:
+        # Missing or truncated mp4, or a duration ffprobe could not read either
+        raise RuntimeError(f"Cannot read the duration of {video_path}: {e!r}") from e
+    # The frames come out in temporal order
+    seconds = sorted(sampler(video_path, duration) if sampler is not None else frame_seconds(duration))
+    extension = 'jpg' if image_format == 'jpeg' else 'png'
+
+    cached = None
+    if cache_folder is not None:
+        paths = [os.path.join(cache_folder, f"frame_{second:.1f}s.{extension}") for second in seconds]
+        if all(os.path.exists(path) for path in paths):
+            cached = []
+            for path in paths:
+                with open(path, 'rb') as f:
+                    cached.append(f.read())
+
+    frames = cached or decode_frames(video_path, seconds, detail, image_format, quality)
+    if cache_folder is not None and cached is None:
+        os.makedirs(cache_folder, exist_ok=True)
+        for second, frame in zip(seconds, frames):
+            with open(os.path.join(cache_folder, f"frame_{second:.1f}s.{extension}"), 'wb') as f:
+                f.write(frame)
+
+    return [f"data:image/{image_format};base64,{base64.b64encode(frame).decode('utf-8')}"
+            for frame in frames]
@@ -0,0 +1,211 @@
+# -*- coding: utf-8 -*-
+"""
+
+Pairwise and average correlations between GPT and the human raters
+
+Python version of 1_*_preprocess_data.R and 2_*_paircorr_avgcorr.R in
+analyze_perceptual_data, producing the same paircorr_table.csv and
+avgcorr_table.csv. The R scripts read one human CSV per feature and
+videoset inside the loop over the GPT datasets and correlate one feature
+at a time. Here all the human ratings are read once (in parallel) into one
+array per videoset, features x items x raters, and every correlation of a
+videoset is computed for all features and GPT datasets at once:
+
+pairwise     correlation of every pair of raters; the mean over the human
+             pairs and over the pairs of GPT with a human
+average      correlation of every human with the mean of the other humans,
+             and of GPT with the mean of all humans
+
+The means over the videosets and the NA handling follow the R scripts.
+Videosets have different numbers of raters; the missing raters are padded
+with NaN and left out of the means.
+
+    python human_agreement.py path/data_frames --modality frames --output path
+
+"""
+import argparse
+import itertools
+import os
+import warnings
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from feature_schema import FEATURES
+
+MODALITIES = {
+    'frames': {'item_order': 'frames_order.csv', 'sep': ',', 'batch_order': 'frame_order', 'extension': '.png'},
+    'clips': {'item_order': 'clip_order.csv', 'sep': ';', 'batch_order': 'clip_order', 'extension': '.mp4'},
+}
+
+# Coughing / sneezing and Vomiting / urinating / defecating are zero in the human data
+HUMAN_FEATURES = [feature for feature in FEATURES
+                  if feature not in ('Coughing / sneezing', 'Vomiting / urinating / defecating')]
+
+# Spelling of the human data where it differs from FEATURES
+HUMAN_NAMES = {'Flirtatious': 'Flirtative'}
+
+def feature_file_name(feature):
+    """ Name of a feature in the human files and in the tables, e.g. Eating_or_drinking. """
+    return HUMAN_NAMES.get(feature, feature).replace(' / ', ' or ').replace(' ', '_')
+
+#%% GPT data (1_*_preprocess_data.R)
+
+def read_gpt_batch(data_folder, modality, batch):
+    """ Ratings of one batch, items (original names without extension) x HUMAN_FEATURES. """
+    settings = MODALITIES[modality]
+    batch_folder = os.path.join(data_folder, f"batch{batch}")
+    data = pd.read_csv(os.path.join(batch_folder, f"batch{batch}_data.csv")).iloc[:, :138]
+    data = data.drop(columns=data.columns[[41, 42]])
+    data.columns = HUMAN_FEATURES
+    order = pd.read_csv(os.path.join(batch_folder, f"batch{batch}_{settings['batch_order']}.csv"), header=None,
+                        encoding='utf-8-sig')[0]
+    codes = pd.read_csv(os.path.join(batch_folder, f"batch{batch}_matchtable.csv"), encoding='utf-8-sig')
+    new_names = codes['New Name'].str.replace(settings['extension'], '', regex=False)
+    original = dict(zip(new_names, codes['Original Name'].str.replace(settings['extension'], '', regex=False)))
+    data.index = order.str.replace(settings['extension'], '', regex=False).map(original)
+    return data.dropna().sort_index()
+
+def gpt_datasets(batches):
+    """ The batches on their common items and features, and the means of every combination of batches.
+
+    batches is a dict {name: DataFrame items x features}. Items missing from
+    a batch and features without any non-zero rating in a batch are left
+    out of all datasets, as in the R preprocessing.
+    """
+    common = sorted(set.intersection(*(set(data.index) for data in batches.values())))
+    data_list = {name: data.loc[common] for name, data in batches.items()}
+    empty = np.zeros(len(HUMAN_FEATURES), dtype=bool)
+    for data in data_list.values():
+        empty |= ~(data > 0).any(axis=0).to_numpy()
+    data_list = {name: data.loc[:, ~empty] for name, data in data_list.items()}
+
+    datasets = dict(data_list)
+    names = list(data_list)
+    for k in range(2, len(names) + 1):
+        for combination in itertools.combinations(names, k):
+            datasets[','.join(combination)] = sum(data_list[name] for name in combination) / k
+    return datasets
+
+#%% Human data
+
+def read_item_order(data_folder, modality):
+    """ Item names (without extension) and their videoset, in the order of the human files. """
+    settings = MODALITIES[modality]
+    order = pd.read_csv(os.path.join(data_folder, settings['item_order']), sep=settings['sep'], encoding='utf-8-sig')
+    order['item'] = order['V1'].str.replace(settings['extension'], '', regex=False)
+    return order
+
+def load_human_ratings(data_folder, modality, features, workers=None):
+    """ {videoset: (items, ratings features x items x raters, raters per feature)}, raters padded with NaN. """
+    human_folder = os.path.join(data_folder, f"data_{modality}_human_individual")
+    order = read_item_order(data_folder, modality)
+    videosets = sorted(order['videoset'].unique())
+    jobs = [(videoset, feature) for videoset in videosets for feature in features]
+
+    def read(job):
+        videoset, feature = job
+        return pd.read_csv(os.path.join(human_folder, f"{feature_file_name(feature)}_{videoset}.csv")).to_numpy(float)
+
+    with ThreadPoolExecutor(workers or os.cpu_count()) as executor:
+        tables = dict(zip(jobs, executor.map(read, jobs)))
+
+    human = {}
+    for videoset in videosets:
+        items = list(order.loc[order['videoset'] == videoset, 'item'])
+        n_raters = np.array([tables[videoset, feature].shape[1] for feature in features])
+        ratings = np.full((len(features), len(items), n_raters.max()), np.nan)
+        for f, feature in enumerate(features):
+            ratings[f, :, :n_raters[f]] = tables[videoset, feature]
+        human[videoset] = (items, ratings, n_raters)
+    return human
+
+#%% Correlations (2_*_paircorr_avgcorr.R)
+
+def _standardize(x, axis):
+    # Centred and scaled to unit norm along axis: the dot product of two such vectors is their correlation
+    x = x - x.mean(axis=axis, keepdims=True)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return x / np.sqrt((x ** 2).sum(axis=axis, keepdims=True))
+
+def _nanmean(x, axis):
+    # Mean without the NA values like mean(na.rm = T); NaN where all are NA
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)
+        return np.nanmean(x, axis=axis)
+
+def videoset_correlations(human, n_raters, gpt):
+    """ Correlations of one videoset for all features at once.
+
+    human: features x items x raters (padded with NaN), n_raters: raters per feature,
+    gpt: datasets x features x items. Returns the human and GPT means of the
+    pairwise correlations and of the correlations with the average of the
+    other humans; the GPT values per dataset and feature.
+    """
+    valid = np.arange(human.shape[2]) < n_raters[:, None]  # features x raters
+
+    # Pairwise correlations, as one batched matrix product per videoset
+    z_human = _standardize(human, axis=1)
+    z_gpt = _standardize(gpt, axis=2)
+    pairs = np.matmul(z_human.transpose(0, 2, 1), z_human)  # features x raters x raters
+    upper = np.triu(np.ones(pairs.shape[1:], dtype=bool), k=1)
+    human_pairs = np.where(upper & valid[:, :, None] & valid[:, None, :], pairs, np.nan)
+    paircorr_human = _nanmean(human_pairs.reshape(len(pairs), -1), axis=1)
+    gpt_pairs = np.einsum('dfi,fir->dfr', z_gpt, z_human)
+    paircorr_gpt = _nanmean(np.where(valid, gpt_pairs, np.nan), axis=2)
+
+    # Every human against the mean of the other humans, GPT against the mean of all humans
+    sums = np.where(valid[:, None, :], human, 0).sum(axis=2, keepdims=True)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        others = (sums - human) / (n_raters[:, None, None] - 1)
+    avg_human = np.einsum('fir,fir->fr', _standardize(others, axis=1), z_human)
+    avgcorr_human = _nanmean(np.where(valid, avg_human, np.nan), axis=1)
+    mean_human = _standardize(sums[:, :, 0] / n_raters[:, None], axis=1)
+    avgcorr_gpt = np.einsum('dfi,fi->df', z_gpt, mean_human)
+    return paircorr_human, paircorr_gpt, avgcorr_human, avgcorr_gpt
+
+def agreement_tables(data_folder, modality='frames', datasets=None, workers=None):
+    """ The paircorr and avgcorr tables: features x GPT datasets, and the human column.
+
+    datasets defaults to the 5 batches in data_folder and their combinations.
+    """
+    if datasets is None:
+        datasets = gpt_datasets({str(batch): read_gpt_batch(data_folder, modality, batch) for batch in range(1, 6)})
+    names = list(datasets)
+    features = list(datasets[names[0]].columns)
+    human = load_human_ratings(data_folder, modality, features, workers)
+
+    results = {'paircorr_human': [], 'paircorr_gpt': [], 'avgcorr_human': [], 'avgcorr_gpt': []}
+    for videoset, (items, ratings, n_raters) in human.items():
+        # Items of this videoset that GPT rated
+        available = set(datasets[names[0]].index)
+        rows = [n for n, item in enumerate(items) if item in available]
+        gpt = np.stack([datasets[name].loc[[items[n] for n in rows]].to_numpy(float).T for name in names])
+        for key, value in zip(results, videoset_correlations(ratings[:, rows], n_raters, gpt)):
+            results[key].append(value)
+
+    # Means over the videosets
+    means = {key: _nanmean(np.stack(values), axis=0) for key, values in results.items()}
+    index = [feature_file_name(feature) for feature in features]
+    paircorr = pd.DataFrame(means['paircorr_gpt'].T, index=index, columns=names)
+    avgcorr = pd.DataFrame(means['avgcorr_gpt'].T, index=index, columns=names)
+    paircorr['human'] = means['paircorr_human']
+    avgcorr['human'] = means['avgcorr_human']
+    return paircorr, avgcorr
+
+def save_tables(paircorr, avgcorr, output_folder='.'):
+    paircorr.to_csv(os.path.join(output_folder, 'paircorr_table.csv'))
+    avgcorr.to_csv(os.path.join(output_folder, 'avgcorr_table.csv'))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Pairwise and average correlations of GPT and human ratings")
+    parser.add_argument('data_folder', help="folder with batch1..batch5, the item order and the human ratings")
+    parser.add_argument('--modality', choices=list(MODALITIES), default='frames')
+    parser.add_argument('--output', default='.', help="folder for paircorr_table.csv and avgcorr_table.csv")
+    parser.add_argument('--workers', type=int, default=None, help="threads reading the human files")
+    args = parser.parse_args()
+    paircorr, avgcorr = agreement_tables(args.data_folder, args.modality, workers=args.workers)
+    save_tables(paircorr, avgcorr, args.output)
+    print(avgcorr.describe().T[['mean', 'min', 'max']])
@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+"""
+
+Packing several images into one rating request
+
+The image experiment sends the whole instruction prompt with its 138
+feature lines for every single image. In packing mode k images go into one
+request, each introduced by its id, the instructions and the feature list
+are sent once, and the answer is a JSON object that follows a strict JSON
+schema: one entry per image id with an integer 0-100 for every feature.
+
+split_packed_response turns the answer back into one response per image in
+the usual chat completion shape, with the ratings of the image as the JSON
+object of structured_output.py, so the records, the ResultWriter and
+Read_GPT-4V_output.py work unchanged.
+
+Structured outputs need a model that supports them (gpt-4o-2024-08-06 or
+later). The model is told to rate every image on its own, but the images of
+a request can still influence each other; choose k with benchmark_packing.py,
+which compares the ratings with single-image mode.
+
+Ref: https://platform.openai.com/docs/guides/structured-outputs
+
+"""
+import copy
+import json
+
+from feature_schema import FEATURES
+from rating_prompts import FEATURE_LIST_HEADER, rating_messages
+from structured_output import ratings_schema
+
+PACKING_INSTRUCTIONS = """
+The input includes {k} separate images, each introduced by its image id.
+Evaluate every image on its own, as if it were the only image: do not compare the images with each other.
+Answer with one entry per image id, rating every feature in the list below for that image.
+"""
+
+def rating_schema(image_ids, features=FEATURES):
+    """ Strict JSON schema of the answer: {"images": [{"image_id": ..., "ratings": {feature: 0-100}}]}. """
+    return {
+        "name": "image_ratings",
+        "strict": True,
+        "schema": {
+            "type": "object",
+            "properties": {
+                "images": {
+                    "type": "array",
+                    "items": {
+                        "type": "object",
+                        "properties": {
+                            "image_id": {"type": "string", "enum": list(image_ids)},
+                            "ratings": {"$ref": "#/$defs/ratings"},
+                        },
+                        "required": ["image_id", "ratings"],
+                        "additionalProperties": False,
+                    },
+                },
+            },
+            "required": ["images"],
+            "additionalProperties": False,
+            "$defs": {"ratings": ratings_schema(features)},
+        },
+    }
+
+def packed_prompt(prompt, k):
+    """ The rating prompt with the packing instructions put before the feature list. """
+    head, sep, tail = prompt.partition(FEATURE_LIST_HEADER)
+    return head.rstrip('\n') + '\n' + PACKING_INSTRUCTIONS.format(k=k) + '\n' + sep + tail
+
+def build_packed_payload(image_urls, prompt, detail='auto', model='gpt-4o-2024-08-06', tokens_per_image=1400):
+    """ Request body rating the images of image_urls ({image id: data URL}) together. """
+    content = []
+    for image_id, image_url in image_urls.items():
+        content.append({"type": "text", "text": f"Image id: {image_id}"})
+        content.append({"type": "image_url", "image_url": {"url": image_url, "detail": detail}})
+    return {
+        "model": model,
+        "messages": rating_messages(packed_prompt(prompt, len(image_urls)), content),
+        "response_format": {"type": "json_schema", "json_schema": rating_schema(image_urls)},
+        "max_tokens": min(16384, 200 + tokens_per_image * len(image_urls)),
+    }
+
+def share_usage(usage, n):
+    """ The token counts of usage divided by n, including the nested *_tokens_details. """
+    shared = {}
+    for key, value in usage.items():
+        if isinstance(value, dict):
+            shared[key] = share_usage(value, n)
+        elif isinstance(value, (int, float)):
+            shared[key] = value / n
+    return shared
+
+def split_packed_response(response, image_ids):
+    """ One chat completion response per image id; ids missing from the answer map to None. """
+    results = dict.fromkeys(image_ids)
+    if 'error' in response or not response.get('choices'):
+        return results
+    try:
+        answer = json.loads(response['choices'][0]['message']['content'])
+        entries = answer['images']
+    except (ValueError, KeyError, TypeError):
+        return results
+
+    usage = response.get('usage', {})
+    shared = share_usage(usage, len(image_ids))
+    for position, entry in enumerate(entries):
+        image_id = entry.get('image_id')
+        if image_id not in results or results[image_id] is not None:
+            continue
+        single = copy.deepcopy({key: value for key, value in response.items() if key not in ('choices', 'usage')})
+        single['choices'] = [{"index": 0, "message": {"role": "assistant",
+                                                       "content": json.dumps(entry.get('ratings', {}))},
+                              "finish_reason": response['choices'][0].get('finish_reason')}]
+        # Token use of the request, shared equally between the images
+        single['usage'] = copy.deepcopy(shared)
+        single['packed'] = {'request_id': response.get('id'), 'k': len(image_ids), 'position': position}
+        results[image_id] = single
+    return results
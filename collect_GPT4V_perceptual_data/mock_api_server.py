@@ -0,0 +1,197 @@
+# -*- coding: utf-8 -*-
+"""
+
+Local stand-in for the GPT API, for testing and benchmarking the collectors
+without spending credits
+
+POST /v1/chat/completions       answers with all 138 features rated 0-100
+                                (as JSON when the request has a JSON schema)
+POST /v1/audio/transcriptions   answers like Whisper (text or verbose_json)
+
+The latency of every request is drawn from a log-normal distribution
+(median and sigma), and a share of the requests can be answered with 429
+(with retry-after) or 500. The rate limit headers of the API are sent too,
+so the RateLimitScheduler can learn the limits from them. The ratings are
+random but seeded by the request body, so the same request always gets the
+same answer. Prompt caching is emulated too: a prefix of cache_min_tokens
+(1024) or more that was sent before, either the system message or the whole
+prompt of a repeated request, is reported as cached in
+usage.prompt_tokens_details.cached_tokens (in steps of 128 tokens, like the
+API). The rating prompts alone are shorter than that, so only repeated
+requests (the repeated batches) get cache hits, as with the API.
+
+Point the collectors to it with OPENAI_BASE_URL=http://127.0.0.1:8000/v1
+(and any OPENAI_API_KEY for the official client):
+
+    python mock_api_server.py --port 8000 --median 2.0 --sigma 0.5 --rate-429 0.02 --rate-500 0.01
+
+"""
+import argparse
+import hashlib
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from feature_schema import FEATURES
+from rate_limiter import estimate_payload_tokens, estimate_text_tokens
+
+DEFAULT_CONFIG = {
+    'median': 2.0,         # seconds
+    'sigma': 0.5,          # of the log of the latency
+    'rate_429': 0.0,
+    'rate_500': 0.0,
+    'rpm': 10000,          # reported in the x-ratelimit headers
+    'tpm': 2000000,
+    'model': 'gpt-4-turbo-2024-04-09',
+    'cache_min_tokens': 1024,  # shortest prefix that is cached
+}
+
+# Prompt caching of the API: cached in steps of 128 tokens
+CACHE_STEP_TOKENS = 128
+
+def mock_ratings(seed):
+    # Deterministic ratings for a request body
+    rng = random.Random(seed)
+    return '\n'.join(f"{feature}: {rng.randint(0, 100)}" for feature in FEATURES)
+
+def mock_json_ratings(seed, features=FEATURES):
+    rng = random.Random(seed)
+    return {feature: rng.randint(0, 100) for feature in features}
+
+
+class MockAPIHandler(BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'  # keep-alive, like the real API
+    config = DEFAULT_CONFIG
+    stats = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send(self, status, body, content_type='application/json', headers=()):
+        if isinstance(body, (dict, list)):
+            body = json.dumps(body)
+        body = body.encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('x-ratelimit-limit-requests', str(self.config['rpm']))
+        self.send_header('x-ratelimit-limit-tokens', str(self.config['tpm']))
+        self.send_header('x-ratelimit-remaining-requests', str(self.config['rpm'] - 1))
+        self.send_header('x-ratelimit-remaining-tokens', str(self.config['tpm'] - 1))
+        for key, value in headers:
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _cached_tokens(self, messages, prompt_tokens):
+        # Cacheable prefixes, longest first: the whole prompt and the system message
+        prefixes = [(json.dumps(messages, sort_keys=True), prompt_tokens)]
+        if messages and messages[0].get('role') == 'system' and isinstance(messages[0]['content'], str):
+            prefixes.append((messages[0]['content'], estimate_text_tokens(messages[0]['content'])))
+        cached = 0
+        with self.stats['lock']:
+            for text, tokens in prefixes:
+                if tokens < self.config['cache_min_tokens']:
+                    continue
+                key = hashlib.sha256(text.encode('utf-8')).digest()
+                if key in self.stats['prefixes'] and not cached:
+                    cached = tokens // CACHE_STEP_TOKENS * CACHE_STEP_TOKENS
+                self.stats['prefixes'].add(key)
+        return cached
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        config = self.config
+        with self.stats['lock']:
+            self.stats['requests'] += 1
+            self.stats['bytes'] += len(body)
+
+        time.sleep(random.lognormvariate(0, config['sigma']) * config['median'])
+        draw = random.random()
+        if draw < config['rate_429']:
+            self._send(429, {'error': {'message': 'Rate limit reached (mock)', 'type': 'requests'}},
+                       headers=[('retry-after', '1'), ('x-ratelimit-reset-requests', '1s')])
+            return
+        if draw < config['rate_429'] + config['rate_500']:
+            self._send(500, {'error': {'message': 'Internal error (mock)', 'type': 'server_error'}})
+            return
+
+        seed = hashlib.sha256(body).hexdigest()
+        if self.path.endswith('/chat/completions'):
+            try:
+                payload = json.loads(body)
+            except ValueError:
+                self._send(400, {'error': {'message': 'Invalid JSON (mock)'}})
+                return
+            content = mock_ratings(seed)
+            response_format = payload.get('response_format') or {}
+            if response_format.get('type') == 'json_schema':
+                schema = response_format['json_schema']['schema']
+                if 'images' in schema['properties']:
+                    # Packed request: one entry per image id of the schema
+                    image_ids = schema['properties']['images']['items']['properties']['image_id']['enum']
+                    content = json.dumps({'images': [
+                        {'image_id': image_id, 'ratings': mock_json_ratings(seed + image_id)}
+                        for image_id in image_ids]})
+                else:
+                    content = json.dumps(mock_json_ratings(seed, schema['required']))
+            prompt_tokens = estimate_payload_tokens(payload) - payload.get('max_tokens', 0)
+            cached_tokens = self._cached_tokens(payload.get('messages') or [], prompt_tokens)
+            self._send(200, {
+                'id': f'chatcmpl-mock-{seed[:12]}',
+                'object': 'chat.completion',
+                'created': int(time.time()),
+                'model': config['model'],
+                'choices': [{'index': 0, 'message': {'role': 'assistant', 'content': content},
+                             'finish_reason': 'stop'}],
+                'usage': {'prompt_tokens': prompt_tokens, 'completion_tokens': len(FEATURES) * 4,
+                          'total_tokens': prompt_tokens + len(FEATURES) * 4,
+                          'prompt_tokens_details': {'cached_tokens': min(cached_tokens, prompt_tokens)}},
+            })
+        elif self.path.endswith('/audio/transcriptions'):
+            text = f"Mock transcript {seed[:8]}. Someone is talking in this clip."
+            if b'name="response_format"\r\n\r\nverbose_json' in body:
+                self._send(200, {'task': 'transcribe', 'language': 'english', 'duration': 3.0, 'text': text,
+                                 'segments': [{'id': 0, 'start': 0.0, 'end': 3.0, 'text': text,
+                                               'no_speech_prob': 0.01}]})
+            else:
+                self._send(200, text + '\n', content_type='text/plain')
+        else:
+            self._send(404, {'error': {'message': f'Unknown path {self.path} (mock)'}})
+
+
+def start_server(port=8000, host='127.0.0.1', **config):
+    """ Run the mock API on a background thread; returns the server (server.shutdown() stops it). """
+    handler = type('ConfiguredHandler', (MockAPIHandler,), {
+        'config': {**DEFAULT_CONFIG, **config},
+        'stats': {'requests': 0, 'bytes': 0, 'prefixes': set(), 'lock': threading.Lock()},
+    })
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    server.stats = handler.stats
+    return server
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Local stand-in for the GPT API")
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--median', type=float, default=DEFAULT_CONFIG['median'], help="median latency in seconds")
+    parser.add_argument('--sigma', type=float, default=DEFAULT_CONFIG['sigma'], help="spread of the latency")
+    parser.add_argument('--rate-429', type=float, default=0.0, help="share of requests answered with 429")
+    parser.add_argument('--rate-500', type=float, default=0.0, help="share of requests answered with 500")
+    parser.add_argument('--cache-min-tokens', type=int, default=DEFAULT_CONFIG['cache_min_tokens'],
+                        help="shortest prefix reported as cached")
+    args = parser.parse_args()
+    server = start_server(args.port, median=args.median, sigma=args.sigma,
+                          rate_429=args.rate_429, rate_500=args.rate_500,
+                          cache_min_tokens=args.cache_min_tokens)
+    print(f"Mock API on http://127.0.0.1:{args.port}/v1, Ctrl+C to stop")
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        server.shutdown()
@@ -0,0 +1,149 @@
+# -*- coding: utf-8 -*-
+"""
+
+Output format of the experiment scripts: one compact JSON record per line
+
+Each record holds the item id (image file or video subfolder), the rating
+batch, the model, a UTC timestamp and the raw API response:
+
+{"id": "frame_001.png", "batch": "batch1", "model": "gpt-4-vision-preview", "timestamp": "...", "response": {...}}
+
+iter_records streams the records of a file lazily, so outputs of many
+batches can be read in constant memory. Older outputs written as
+pretty-printed JSON objects one after another are still read, with the
+record fields other than the response left empty.
+
+"""
+import json
+import os
+import re
+import threading
+from datetime import datetime, timezone
+
+#%% Writing
+
+def make_record(item_id, response, batch=None, model=None):
+    return {
+        "id": item_id,
+        "batch": batch,
+        "model": model or response.get('model'),
+        "timestamp": datetime.now(timezone.utc).isoformat(timespec='seconds'),
+        "response": response,
+    }
+
+def append_record(outfile, item_id, response, batch=None, model=None):
+    """ Write one record line to an open text file. """
+    record = make_record(item_id, response, batch, model)
+    outfile.write(json.dumps(record, ensure_ascii=False, separators=(',', ':')) + '\n')
+
+
+class ResultWriter:
+    """ Append a response record and its progress entry as one unit.
+
+    The record is flushed to disk before the item is written to the
+    progress file, so a crash never marks an item done without its result.
+    Rows in the output file stay in the same order as the progress file.
+    With a ResumeIndex the item is also marked done, or failed if the
+    response holds no ratings. Safe to share between threads.
+    """
+
+    def __init__(self, output_file, progress_file, batch=None, index=None):
+        self.output_file = output_file
+        self.progress_file = progress_file
+        self.batch = batch
+        self.index = index
+        self.lock = threading.Lock()
+
+    def write(self, item_id, response, model=None):
+        with self.lock:
+            with open(self.output_file, 'a', encoding='utf-8') as outfile:
+                append_record(outfile, item_id, response, self.batch, model)
+                outfile.flush()
+                os.fsync(outfile.fileno())
+
+            with open(self.progress_file, 'a') as f:
+                f.write(item_id + '\n')
+                f.flush()
+                os.fsync(f.fileno())
+
+            if self.index is not None:
+                error = response_error(response)
+                if error is None:
+                    self.index.mark_done(item_id)
+                else:
+                    self.index.mark_failed(item_id, error)
+
+#%% Reading
+
+def _legacy_record(response):
+    return {"id": None, "batch": None, "model": response.get('model'), "timestamp": None,
+            "response": response}
+
+def _iter_concatenated(file, chunk_size=1 << 20):
+    # Objects written back to back with indent=4; decode them from a rolling buffer
+    decoder = json.JSONDecoder()
+    whitespace = re.compile(r'\s*')
+    buffer = ''
+    while True:
+        chunk = file.read(chunk_size)
+        buffer += chunk
+        pos = whitespace.match(buffer).end()
+        while pos < len(buffer):
+            try:
+                obj, pos = decoder.raw_decode(buffer, pos)
+            except json.JSONDecodeError:
+                if not chunk:
+                    print(f"Error decoding JSON near: {buffer[pos:pos + 80]!r}")
+                    return
+                break  # the object continues in the next chunk
+            yield obj
+            pos = whitespace.match(buffer, pos).end()
+        buffer = buffer[pos:]
+        if not chunk:
+            return
+
+def iter_records(file_path):
+    """ Yield the records of an output file one at a time. """
+    with open(file_path, 'r', encoding='utf-8') as file:
+        first_line = file.readline()
+        try:
+            first = json.loads(first_line)
+            legacy = not isinstance(first, dict) or 'response' not in first
+        except json.JSONDecodeError:
+            legacy = True
+        file.seek(0)
+
+        if legacy:
+            for obj in _iter_concatenated(file):
+                yield _legacy_record(obj)
+            return
+
+        for line in file:
+            if not line.strip():
+                continue
+            try:
+                yield json.loads(line)
+            except json.JSONDecodeError as e:
+                # e.g. a line cut short by a crash
+                print(f"Error decoding JSON: {e}")
+
+def response_error(response):
+    """ Why a response holds no ratings (error or refusal), or None if it does. """
+    content = response_content(response)
+    if content is None:
+        return 'empty response'
+    if 'error' in response:
+        return content or 'error response'
+    if not content.strip():
+        return 'empty answer'
+    if content.strip().lstrip('{').startswith("I'm sorry"):
+        return 'refused'
+    return None
+
+def response_content(response):
+    """ The answer text of a response, the error message for failed requests, else None. """
+    if 'error' in response:
+        return response['error'].get('message', '')
+    if 'choices' in response and len(response['choices']) > 0:
+        return response['choices'][0]['message']['content']
+    return None
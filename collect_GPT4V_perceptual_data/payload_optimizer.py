@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+"""
+
+Image payload optimizer: resize, re-encode and choose the detail level
+
+The API scales every image to its tile grid anyway (fit 2048 x 2048, then the
+shortest side to 768, billed per 512 x 512 tile), so sending the frames at
+full resolution only inflates the upload. The optimizer resizes to the size
+the model actually sees (optionally fewer tiles), re-encodes to JPEG or WebP
+and logs the bytes and estimated image tokens saved for every item.
+
+Ref: https://platform.openai.com/docs/guides/vision/calculating-costs
+
+"""
+import base64
+import csv
+import io
+import math
+import os
+import threading
+
+from PIL import Image
+
+from rate_limiter import estimate_image_tokens
+
+MIME_TYPES = {'JPEG': 'image/jpeg', 'WEBP': 'image/webp', 'PNG': 'image/png'}
+
+def target_size(width, height, detail='high', max_tiles=None):
+    """ Size of the image as the model sees it, shrunk further to at most max_tiles tiles. """
+    if detail == 'low':
+        scale = min(1.0, 512 / max(width, height))
+    else:
+        scale = min(1.0, 2048 / max(width, height))
+        scale *= min(1.0, 768 / (min(width, height) * scale))
+    width, height = width * scale, height * scale
+    if max_tiles is not None and detail != 'low':
+        while math.ceil(width / 512) * math.ceil(height / 512) > max_tiles:
+            # Snap the longer side down onto the next tile boundary
+            if width >= height:
+                step = (math.ceil(width / 512) - 1) * 512 / width
+            else:
+                step = (math.ceil(height / 512) - 1) * 512 / height
+            width, height = width * step, height * step
+    return max(1, int(width)), max(1, int(height))
+
+
+class PayloadOptimizer:
+
+    def __init__(self, detail='high', image_format='JPEG', quality=85, max_tiles=None, log_file=None):
+        self.detail = detail
+        self.image_format = image_format.upper()
+        self.quality = quality
+        self.max_tiles = max_tiles
+        self.log_file = log_file
+        self.totals = {'items': 0, 'original_bytes': 0, 'optimized_bytes': 0,
+                       'original_tokens': 0, 'optimized_tokens': 0}
+        self.lock = threading.Lock()  # the async image mode optimizes on several threads
+
+    def optimize(self, image_bytes):
+        """ Return the optimized image bytes and the sizes before and after. """
+        image = Image.open(io.BytesIO(image_bytes))
+        original_size = image.size
+        size = target_size(*original_size, self.detail, self.max_tiles)
+        if size != original_size:
+            image = image.resize(size, Image.LANCZOS)
+        if self.image_format == 'JPEG' and image.mode not in ('RGB', 'L'):
+            image = image.convert('RGB')
+        output = io.BytesIO()
+        image.save(output, self.image_format, quality=self.quality)
+        return output.getvalue(), original_size, size
+
+    def data_url(self, image_path):
+        """ Base64 data URL of the optimized image; the savings are logged. """
+        with open(image_path, 'rb') as f:
+            image_bytes = f.read()
+        optimized, original_size, size = self.optimize(image_bytes)
+
+        # The full size image would have been sent with detail "auto" (= high)
+        row = {'item': os.path.basename(image_path),
+               'original_bytes': len(image_bytes), 'optimized_bytes': len(optimized),
+               'original_tokens': estimate_image_tokens(*original_size),
+               'optimized_tokens': estimate_image_tokens(*size, detail=self.detail)}
+        self._log(row)
+        encoded = base64.b64encode(optimized).decode('utf-8')
+        return f"data:{MIME_TYPES[self.image_format]};base64,{encoded}"
+
+    def _log(self, row):
+        with self.lock:
+            self.totals['items'] += 1
+            for key in ('original_bytes', 'optimized_bytes', 'original_tokens', 'optimized_tokens'):
+                self.totals[key] += row[key]
+            if self.log_file is None:
+                return
+            new_file = not os.path.exists(self.log_file)
+            with open(self.log_file, 'a', newline='') as f:
+                writer = csv.DictWriter(f, fieldnames=list(row))
+                if new_file:
+                    writer.writeheader()
+                writer.writerow(row)
+
+    def summary(self):
+        totals = self.totals
+        saved_bytes = totals['original_bytes'] - totals['optimized_bytes']
+        saved_tokens = totals['original_tokens'] - totals['optimized_tokens']
+        print(f"Optimized {totals['items']} images: {saved_bytes / 1e6:.1f} MB "
+              f"({saved_bytes / max(1, totals['original_bytes']):.0%}) and about {saved_tokens} image tokens "
+              f"({saved_tokens / max(1, totals['original_tokens']):.0%}) saved.")
+        return totals
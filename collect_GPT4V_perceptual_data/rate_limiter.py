@@ -0,0 +1,211 @@
+# -*- coding: utf-8 -*-
+"""
+
+Request- and token-rate aware pacing shared by the GPT and Whisper scripts
+
+Keeps throughput just under the requests-per-minute (RPM) and
+tokens-per-minute (TPM) limits of the account and backs off with jittered
+exponential delays on 429 and 5xx responses instead of fixed sleeps.
+The limits can be given directly or are learnt from the rate limit headers
+returned with every response.
+
+Ref: https://platform.openai.com/docs/guides/rate-limits
+https://platform.openai.com/docs/guides/vision/calculating-costs
+
+"""
+import asyncio
+import base64
+import json
+import math
+import random
+import re
+import struct
+import threading
+import time
+from collections import deque
+
+#%% Token estimates
+
+def estimate_text_tokens(text):
+    # Roughly 4 characters per token for English text
+    return len(text) // 4 + 1
+
+def image_size_from_data_url(url):
+    """ Read (width, height) from the header of a base64 PNG or JPEG data URL. """
+    encoded = url.split(',', 1)[-1]
+    try:
+        head = base64.b64decode(encoded[:65536] + '=' * (-len(encoded[:65536]) % 4))
+    except ValueError:
+        return None
+    if head[:8] == b'\x89PNG\r\n\x1a\n' and len(head) >= 24:
+        return struct.unpack('>II', head[16:24])
+    if head[:2] == b'\xff\xd8':
+        i = 2
+        while i + 9 < len(head):
+            if head[i] != 0xFF:
+                i += 1
+                continue
+            marker = head[i + 1]
+            # Start of frame markers hold the image size
+            if 0xC0 <= marker <= 0xCF and marker not in (0xC4, 0xC8, 0xCC):
+                height, width = struct.unpack('>HH', head[i + 5:i + 9])
+                return width, height
+            i += 2 + struct.unpack('>H', head[i + 2:i + 4])[0]
+    return None
+
+def estimate_image_tokens(width=None, height=None, detail='auto'):
+    """ Image tokens as billed by the vision models (85 base + 170 per 512px tile). """
+    if detail == 'low':
+        return 85
+    if width is None or height is None:
+        return 765  # a 1024 x 1024 image
+    # Fit within 2048 x 2048, then scale the shortest side down to 768
+    scale = min(1.0, 2048 / max(width, height))
+    width, height = width * scale, height * scale
+    scale = min(1.0, 768 / min(width, height))
+    width, height = width * scale, height * scale
+    return 85 + 170 * math.ceil(width / 512) * math.ceil(height / 512)
+
+def estimate_payload_tokens(payload):
+    """ Tokens counted against the TPM limit for a chat completion payload.
+
+    The prompt text, the images and max_tokens all count towards the limit.
+    """
+    if isinstance(payload, (str, bytes)):
+        payload = json.loads(payload)
+    tokens = payload.get('max_tokens', 0)
+    for message in payload.get('messages', []):
+        content = message.get('content', '')
+        if isinstance(content, str):
+            tokens += estimate_text_tokens(content)
+            continue
+        for part in content:
+            if part.get('type') == 'text':
+                tokens += estimate_text_tokens(part['text'])
+            elif part.get('type') == 'image_url':
+                image_url = part['image_url']
+                size = image_size_from_data_url(image_url['url']) or (None, None)
+                tokens += estimate_image_tokens(*size, detail=image_url.get('detail', 'auto'))
+    return tokens
+
+#%% Rate limit headers
+
+def parse_reset(value):
+    """ Convert reset values such as '1s', '6m0s' or '20ms' into seconds. """
+    if value is None:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    units = {'h': 3600, 'm': 60, 's': 1, 'ms': 0.001}
+    parts = re.findall(r'([\d.]+)(ms|h|m|s)', value)
+    if not parts:
+        return None
+    return sum(float(number) * units[unit] for number, unit in parts)
+
+def retry_after(headers):
+    """ Seconds the server asked us to wait, if any. """
+    headers = {key.lower(): value for key, value in dict(headers).items()}
+    if 'retry-after-ms' in headers:
+        return float(headers['retry-after-ms']) / 1000
+    return parse_reset(headers.get('retry-after'))
+
+def is_retryable(status):
+    return status == 429 or status >= 500
+
+#%% Scheduler
+
+class RateLimitScheduler:
+    """ Paces requests under the RPM and TPM limits with a sliding one-minute window.
+
+    rpm and tpm are the account limits; headroom is the fraction of them we
+    aim to use. Limits that are not given are taken from the
+    x-ratelimit-limit-* response headers. Safe to share between threads.
+    """
+
+    def __init__(self, rpm=None, tpm=None, headroom=0.9, base_delay=1.0, max_delay=60.0):
+        self.rpm = rpm
+        self.tpm = tpm
+        self.headroom = headroom
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.window = deque()  # (time sent, tokens) of requests in the last minute
+        self.window_tokens = 0
+        self.blocked_until = 0.0
+        self.lock = threading.Lock()
+
+    def _expire(self, now):
+        while self.window and now - self.window[0][0] >= 60:
+            self.window_tokens -= self.window.popleft()[1]
+
+    def reserve(self, tokens=0):
+        """ Book a request if it fits the budget now, else return the seconds to wait. """
+        with self.lock:
+            now = time.monotonic()
+            self._expire(now)
+            if now < self.blocked_until:
+                return self.blocked_until - now
+
+            wait = 0.0
+            if self.rpm and len(self.window) + 1 > max(1, self.rpm * self.headroom):
+                wait = self.window[0][0] + 60 - now
+            if self.tpm and self.window and self.window_tokens + tokens > self.tpm * self.headroom:
+                # Wait until enough of the earlier requests leave the window
+                excess = self.window_tokens + tokens - self.tpm * self.headroom
+                for sent, used in self.window:
+                    excess -= used
+                    if excess <= 0:
+                        break
+                wait = max(wait, sent + 60 - now)
+            if wait > 0:
+                return wait
+
+            self.window.append((now, tokens))
+            self.window_tokens += tokens
+            return 0.0
+
+    def acquire(self, tokens=0):
+        """ Block until the request fits under the limits. """
+        while True:
+            wait = self.reserve(tokens)
+            if wait <= 0:
+                return
+            time.sleep(wait)
+
+    async def acquire_async(self, tokens=0):
+        while True:
+            wait = self.reserve(tokens)
+            if wait <= 0:
+                return
+            await asyncio.sleep(wait)
+
+    def update_from_headers(self, headers):
+        """ Learn the limits and pause when the server reports the budget is used up. """
+        headers = {key.lower(): value for key, value in dict(headers).items()}
+        with self.lock:
+            if self.rpm is None and 'x-ratelimit-limit-requests' in headers:
+                self.rpm = int(headers['x-ratelimit-limit-requests'])
+            if self.tpm is None and 'x-ratelimit-limit-tokens' in headers:
+                self.tpm = int(headers['x-ratelimit-limit-tokens'])
+
+            now = time.monotonic()
+            for kind in ('requests', 'tokens'):
+                remaining = headers.get(f'x-ratelimit-remaining-{kind}')
+                reset = parse_reset(headers.get(f'x-ratelimit-reset-{kind}'))
+                if remaining is not None and reset is not None and int(remaining) <= 0:
+                    self.blocked_until = max(self.blocked_until, now + reset)
+
+    def backoff(self, attempt, server_delay=None, shared=True):
+        """ Full-jitter exponential delay for the given retry attempt (0-based).
+
+        With shared=True (rate limited) every request waits out the delay;
+        otherwise only the caller sleeps it, e.g. for a 5xx on a single item.
+        """
+        delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+        if server_delay is not None:
+            delay = max(delay, server_delay)
+        if shared:
+            with self.lock:
+                self.blocked_until = max(self.blocked_until, time.monotonic() + delay)
+        return delay
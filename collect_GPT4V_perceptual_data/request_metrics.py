@@ -0,0 +1,155 @@
+# -*- coding: utf-8 -*-
+"""
+
+Per-request metrics of the experiment scripts and a run report
+
+post_with_backoff writes one JSON line per item to the metrics file:
+queue wait (time spent waiting for the rate limiter), time to the response
+headers (TTFB, including the upload), latency of the successful attempt,
+total time including retries and backoff, payload bytes, prompt and
+completion tokens from the usage field, the prompt tokens served from the
+prompt cache of the API (cached_tokens), the HTTP status of every attempt
+and the estimated cost.
+
+The report gives p50/p95/p99 latencies, throughput, tokens, the prompt
+cache hit rate, cost and the error breakdown per batch (or per model):
+
+    python request_metrics.py metrics.jsonl
+    python request_metrics.py metrics.jsonl --by model
+
+"""
+import argparse
+import json
+import threading
+import time
+from collections import Counter
+
+import numpy as np
+
+# USD per million prompt and completion tokens; check the price list before relying on the costs
+PRICES = {
+    'gpt-4-turbo': (10.0, 30.0),
+    'gpt-4-vision-preview': (10.0, 30.0),
+    'gpt-4o': (5.0, 15.0),
+    'gpt-4o-2024-08-06': (2.5, 10.0),  # the snapshot of structured_output.JSON_MODEL
+    'gpt-4o-mini': (0.15, 0.6),
+}
+
+# Share of the prompt price paid for prompt tokens served from the prompt cache
+CACHED_PRICE_SHARE = 0.5
+
+def request_cost(model, prompt_tokens, completion_tokens, cached_tokens=0):
+    for name in sorted(PRICES, key=len, reverse=True):
+        if model and model.startswith(name):
+            prompt_price, completion_price = PRICES[name]
+            prompt_cost = (prompt_tokens - cached_tokens + cached_tokens * CACHED_PRICE_SHARE) * prompt_price
+            return (prompt_cost + completion_tokens * completion_price) / 1e6
+    return None
+
+
+class MetricsLog:
+
+    def __init__(self, path='metrics.jsonl', **fields):
+        self.path = path
+        self.fields = fields
+        self.lock = threading.Lock()
+        self.file = open(path, 'a', encoding='utf-8')
+
+    def with_fields(self, **fields):
+        """ The same log, with more fields (e.g. batch) added to every record. """
+        view = object.__new__(MetricsLog)
+        view.__dict__.update(self.__dict__)
+        view.fields = {**self.fields, **fields}
+        return view
+
+    def record(self, **values):
+        record = {'time': time.time(), **self.fields, **values}
+        usage = values.get('usage') or {}
+        record.pop('usage', None)
+        record['prompt_tokens'] = usage.get('prompt_tokens', 0)
+        record['completion_tokens'] = usage.get('completion_tokens', 0)
+        record['cached_tokens'] = (usage.get('prompt_tokens_details') or {}).get('cached_tokens', 0)
+        record['cost'] = request_cost(record.get('model'), record['prompt_tokens'], record['completion_tokens'],
+                                      record['cached_tokens'])
+        line = json.dumps(record, ensure_ascii=False, separators=(',', ':'))
+        with self.lock:
+            self.file.write(line + '\n')
+            self.file.flush()
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+
+#%% Report
+
+def load_metrics(path='metrics.jsonl'):
+    with open(path, 'r', encoding='utf-8') as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+def _percentiles(values):
+    if not values:
+        return {'p50': None, 'p95': None, 'p99': None}
+    p50, p95, p99 = np.percentile(values, [50, 95, 99])
+    return {'p50': round(p50, 3), 'p95': round(p95, 3), 'p99': round(p99, 3)}
+
+def summarize(records, by='batch'):
+    """ Latency percentiles, throughput, tokens, cost and errors per group of requests. """
+    groups = {}
+    for record in records:
+        groups.setdefault(str(record.get(by)), []).append(record)
+
+    summary = {}
+    for name, group in groups.items():
+        sent = [r for r in group if not r.get('cached')]
+        ok = [r for r in sent if r.get('status') == 200]
+        # Wall time from the first request being queued to the last one finishing
+        span = (max(r['time'] for r in group) - min(r['time'] - r.get('total', 0) for r in group)) if group else 0
+        costs = [r['cost'] for r in group if r.get('cost') is not None]
+        sent_prompt_tokens = sum(r.get('prompt_tokens', 0) for r in sent)
+        cached_tokens = sum(r.get('cached_tokens', 0) for r in sent)
+        summary[name] = {
+            'requests': len(group),
+            'cached': len(group) - len(sent),
+            'ok': len(ok),
+            'retries': sum(r.get('retries', 0) for r in sent),
+            'errors': dict(Counter(str(r.get('status')) for r in sent if r.get('status') != 200)),
+            'retried_statuses': dict(Counter(str(s) for r in sent for s in r.get('statuses', [])[:-1])),
+            'latency': _percentiles([r['latency'] for r in ok if r.get('latency') is not None]),
+            'ttfb': _percentiles([r['ttfb'] for r in ok if r.get('ttfb') is not None]),
+            'queue_wait': _percentiles([r['queue_wait'] for r in sent]),
+            'total': _percentiles([r['total'] for r in sent]),
+            'throughput_per_min': round(len(group) / span * 60, 2) if span > 0 else None,
+            'payload_mb': round(sum(r.get('payload_bytes', 0) for r in sent) / 1e6, 2),
+            'prompt_tokens': sum(r.get('prompt_tokens', 0) for r in group),
+            'completion_tokens': sum(r.get('completion_tokens', 0) for r in group),
+            'cached_tokens': cached_tokens,
+            'prompt_cache_hit_rate': round(cached_tokens / sent_prompt_tokens, 3) if sent_prompt_tokens else None,
+            # Latency of the requests with and without a prompt cache hit
+            'latency_cache_hit': _percentiles([r['latency'] for r in ok
+                                               if r.get('latency') is not None and r.get('cached_tokens')]),
+            'latency_cache_miss': _percentiles([r['latency'] for r in ok
+                                                if r.get('latency') is not None and not r.get('cached_tokens')]),
+            'cost_usd': round(sum(costs), 4) if costs else None,
+        }
+    return summary
+
+def print_summary(summary):
+    for name, s in summary.items():
+        print(f"== {name}: {s['requests']} requests ({s['cached']} cached), {s['ok']} ok, {s['retries']} retries")
+        print(f"   latency s  p50 {s['latency']['p50']}  p95 {s['latency']['p95']}  p99 {s['latency']['p99']}")
+        print(f"   TTFB s     p50 {s['ttfb']['p50']}  p95 {s['ttfb']['p95']}  p99 {s['ttfb']['p99']}")
+        print(f"   queue s    p50 {s['queue_wait']['p50']}  p95 {s['queue_wait']['p95']}  p99 {s['queue_wait']['p99']}")
+        print(f"   throughput {s['throughput_per_min']} requests/min, upload {s['payload_mb']} MB")
+        print(f"   tokens     {s['prompt_tokens']} prompt, {s['completion_tokens']} completion, cost ${s['cost_usd']}")
+        print(f"   prompt cache {s['cached_tokens']} tokens, hit rate {s['prompt_cache_hit_rate']}, "
+              f"latency p50 {s['latency_cache_hit']['p50']} hit / {s['latency_cache_miss']['p50']} miss")
+        if s['errors'] or s['retried_statuses']:
+            print(f"   errors     {s['errors']}  retried {s['retried_statuses']}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Report of the per-request metrics of a run")
+    parser.add_argument('metrics_file', nargs='?', default='metrics.jsonl')
+    parser.add_argument('--by', default='batch', help="field to group by, e.g. batch or model")
+    args = parser.parse_args()
+    print_summary(summarize(load_metrics(args.metrics_file), args.by))
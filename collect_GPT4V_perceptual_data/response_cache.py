@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+"""
+
+Local on-disk cache of API responses, keyed by the contents of the request
+
+The key is a hash of the whole payload (model, prompt text, image bytes and
+settings), so re-running an experiment with a new output file only sends
+the requests whose contents actually changed. The repeated batches of an
+experiment send the same payloads but need independent answers, so the
+batch is part of the key too (for_batch). Only answers with ratings are
+stored; errors, refusals and empty answers are sent again next time. When
+the cache grows over max_bytes the least recently used entries are
+evicted.
+
+"""
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+
+from output_records import response_error
+
+def payload_key(payload, batch=None):
+    if isinstance(payload, (str, bytes)):
+        payload = json.loads(payload)
+    canonical = json.dumps(payload, sort_keys=True, ensure_ascii=False, separators=(',', ':'))
+    if batch is not None:
+        canonical = f"{batch}\n{canonical}"
+    return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+
+class ResponseCache:
+
+    def __init__(self, path='response_cache.sqlite', max_bytes=2 * 1024 ** 3):
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.batch = None
+        self.counts = {'hits': 0, 'misses': 0}
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("""CREATE TABLE IF NOT EXISTS responses (
+                               key TEXT PRIMARY KEY,
+                               response TEXT NOT NULL,
+                               size INTEGER NOT NULL,
+                               last_used REAL NOT NULL)""")
+        self.db.execute("CREATE INDEX IF NOT EXISTS responses_last_used ON responses (last_used)")
+        self.db.commit()
+
+    def for_batch(self, batch):
+        """ The same cache, with the answers of one batch kept apart from the other batches. """
+        view = object.__new__(ResponseCache)
+        view.__dict__.update(self.__dict__)
+        view.batch = batch
+        return view
+
+    def get(self, payload):
+        key = payload_key(payload, self.batch)
+        with self.lock:
+            row = self.db.execute("SELECT response FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.counts['misses'] += 1
+                return None
+            self.counts['hits'] += 1
+            self.db.execute("UPDATE responses SET last_used = ? WHERE key = ?", (time.time(), key))
+            self.db.commit()
+        return json.loads(row[0])
+
+    def put(self, payload, response):
+        if response_error(response) is not None:
+            return  # do not keep errors, refusals or empty answers
+        key = payload_key(payload, self.batch)
+        text = json.dumps(response, ensure_ascii=False)
+        with self.lock:
+            self.db.execute("INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?)",
+                            (key, text, len(text), time.time()))
+            self._evict()
+            self.db.commit()
+
+    def _evict(self):
+        total = self.db.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        # Drop the least recently used entries until the cache fits again
+        rows = self.db.execute("SELECT key, size FROM responses ORDER BY last_used").fetchall()
+        evicted = []
+        for key, size in rows:
+            if total <= self.max_bytes:
+                break
+            evicted.append((key,))
+            total -= size
+        self.db.executemany("DELETE FROM responses WHERE key = ?", evicted)
+
+    def stats(self):
+        with self.lock:
+            entries, size = self.db.execute(
+                "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses").fetchone()
+        return {**self.counts, 'entries': entries, 'bytes': size}
+
+    def close(self):
+        with self.lock:
+            self.db.close()
@@ -0,0 +1,153 @@
+# -*- coding: utf-8 -*-
+"""
+
+Inline validation of the ratings, with partial re-asks
+
+Every response is parsed against the 138-feature schema as soon as it
+arrives, instead of finding the NaN rows afterwards in Read_GPT-4V_output.py:
+
+refused or no ratings    the whole request is sent again after a backoff
+features missing         a short follow-up request asks for only the missing
+(or cut off at           features (same images and transcript, the feature
+max_tokens)              list cut down to those features, small max_tokens)
+
+The answers of the follow-ups are appended to the content of the first
+response, so the saved record parses like a complete one; the number of
+features missing before and after and the follow-ups sent are kept under
+"validation" in the response.
+
+For JSON answers (structured_output.py) the follow-up schema asks for the
+missing features only, and the two JSON objects are merged.
+
+"""
+import copy
+import json
+import threading
+import time
+
+import numpy as np
+
+from api_client import post_with_backoff
+from feature_parser import FeatureParser
+from output_records import response_content, response_error
+from rating_prompts import FEATURE_LIST_HEADER, replace_prompt
+from structured_output import is_json_answer, ratings_format
+
+def split_prompt(text):
+    """ Instructions and the feature lines ("Feature:?") of a rating prompt. """
+    head, sep, tail = text.partition(FEATURE_LIST_HEADER)
+    if not sep:
+        return text, []
+    return head, [line.strip() for line in tail.split('\n') if line.strip()]
+
+def merge_answers(content, extra):
+    """ The answer of a follow-up added to the first answer. """
+    if is_json_answer(content) and is_json_answer(extra):
+        try:
+            return json.dumps({**json.loads(content), **json.loads(extra)}, ensure_ascii=False)
+        except ValueError:
+            pass  # a cut off answer; keep both texts, the parser reads the pairs of both
+    return content.rstrip('\n') + '\n' + extra.strip('\n')
+
+
+class ResponseValidator:
+
+    def __init__(self, parser=None, max_follow_ups=2, max_refusal_retries=2, tokens_per_feature=8):
+        self.parser = parser or FeatureParser()
+        self.max_follow_ups = max_follow_ups
+        self.max_refusal_retries = max_refusal_retries
+        self.tokens_per_feature = tokens_per_feature
+        self.counts = {'responses': 0, 'complete': 0, 'refusal_retries': 0, 'follow_ups': 0,
+                       'features_recovered': 0, 'incomplete': 0}
+        self.lock = threading.Lock()  # responses are validated on several threads
+
+    def _count(self, key, n=1):
+        with self.lock:
+            self.counts[key] += n
+
+    def missing(self, response):
+        """ Columns of the features without a rating; None if the response holds no ratings at all. """
+        if response_error(response) is not None:
+            return None
+        row = np.full(len(self.parser.features), np.nan, dtype=np.float32)
+        if self.parser.parse_into(response_content(response), row) == 0:
+            return None
+        return [int(col) for col in np.flatnonzero(np.isnan(row))]
+
+    def follow_up_payload(self, payload, missing):
+        """ The same request, asking only for the missing features. """
+        if isinstance(payload, (str, bytes)):
+            payload = json.loads(payload)
+        follow_up = copy.copy(payload)
+        follow_up['messages'] = copy.deepcopy(payload['messages'])
+        missing = set(missing)
+
+        def ask_missing(text):
+            head, lines = split_prompt(text)
+            # Keep the spelling of the prompt for the features asked again
+            lines = [line for line in lines if self.parser.column(line.rstrip('?').rstrip(':')) in missing]
+            return f"{head}{FEATURE_LIST_HEADER}\n" + '\n'.join(lines) + '\n'
+
+        replace_prompt(follow_up['messages'], ask_missing)
+        if payload.get('response_format', {}).get('type') == 'json_schema':
+            follow_up['response_format'] = ratings_format([self.parser.features[col] for col in sorted(missing)])
+        follow_up['max_tokens'] = min(payload.get('max_tokens', 4096), 64 + self.tokens_per_feature * len(missing))
+        return follow_up
+
+    def post(self, pool, payload, headers, scheduler, label='', cache=None, metrics=None):
+        """ post_with_backoff, then re-ask refusals and missing features; returns the merged response. """
+        response = post_with_backoff(pool, payload, headers, scheduler, label=label, cache=cache, metrics=metrics)
+        if response is None or 'error' in response:
+            return response
+        self._count('responses')
+
+        # Refusals and answers without any rating: send the whole request again
+        missing = self.missing(response)
+        for attempt in range(self.max_refusal_retries):
+            if missing is not None:
+                break
+            delay = scheduler.backoff(attempt, shared=False)
+            print(f"No ratings for {label}, asking again in {delay:.1f} seconds.")
+            time.sleep(delay)
+            self._count('refusal_retries')
+            # Not from the cache, which would give the same answer back
+            retry = post_with_backoff(pool, payload, headers, scheduler, label=label, metrics=metrics)
+            if retry is None or 'error' in retry:
+                continue
+            response = retry
+            missing = self.missing(response)
+            if missing is not None and cache is not None:
+                cache.put(payload, response)
+        if missing is None:
+            self._count('incomplete')
+            return response
+
+        # Some features missing or cut off: ask for just those
+        validation = {'missing_before': len(missing), 'follow_ups': 0}
+        for _ in range(self.max_follow_ups):
+            if not missing:
+                break
+            follow_up = self.follow_up_payload(payload, missing)
+            answer = post_with_backoff(pool, follow_up, headers, scheduler, label=f"{label} (follow-up)",
+                                       metrics=metrics)
+            validation['follow_ups'] += 1
+            self._count('follow_ups')
+            if answer is None or response_content(answer) is None or 'error' in answer:
+                continue
+            message = response['choices'][0]['message']
+            message['content'] = merge_answers(message['content'], response_content(answer))
+            still_missing = self.missing(response)
+            self._count('features_recovered', len(missing) - len(still_missing))
+            missing = still_missing
+        validation['missing_after'] = len(missing)
+        if validation['missing_before']:
+            response['validation'] = validation
+            # Keep the merged answer, so a rerun does not ask again
+            if cache is not None:
+                cache.put(payload, response)
+        self._count('complete' if not missing else 'incomplete')
+        return response
+
+    def summary(self):
+        print(f"Validation: {self.counts}")
+        return self.counts
@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+"""
+
+Columnar store of the parsed ratings (Parquet, partitioned by modality and batch)
+
+Every output record becomes one row: item id, batch, modality ('frame' for
+the image experiment, 'clip' for the video experiment), model, timestamp,
+prompt, completion and cached prompt tokens, and the 138 ratings as float32 columns named
+by feature. The rows are written in chunks while the output file is
+streamed, into a hive-partitioned dataset:
+
+results/modality=frame/batch=batch1/output_batch1-00000-0.parquet
+
+The files are named after the output file and the chunk, so storing the
+same (or a grown) output file again replaces its rows instead of adding
+them twice.
+
+load_results reads only the partitions and columns asked for, and the
+filters on the ratings are checked against the row group statistics, so
+e.g. all frames of batch2 with Dominant above 50 are read without touching
+the other batches. The R scripts can read the same dataset with
+arrow::open_dataset('results').
+
+"""
+import os
+from datetime import datetime
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.dataset as ds
+
+from feature_parser import FeatureParser
+from feature_schema import FEATURES
+from output_records import iter_records, response_content
+
+PARTITIONING = ds.partitioning(pa.schema([('modality', pa.string()), ('batch', pa.string())]), flavor='hive')
+
+def results_schema(features=FEATURES):
+    return pa.schema([
+        ('id', pa.string()),
+        ('modality', pa.string()),
+        ('batch', pa.string()),
+        ('model', pa.string()),
+        ('timestamp', pa.timestamp('s', tz='UTC')),
+        ('prompt_tokens', pa.int32()),
+        ('completion_tokens', pa.int32()),
+        ('cached_tokens', pa.int32()),
+        *[(feature, pa.float32()) for feature in features],
+    ])
+
+def _timestamp(value):
+    return datetime.fromisoformat(value) if value else None
+
+def _chunk_table(records, ratings, modality, schema):
+    usage = [record['response'].get('usage') or {} for record in records]
+    columns = {
+        'id': [record['id'] for record in records],
+        'modality': [modality] * len(records),
+        'batch': [record['batch'] for record in records],
+        'model': [record['model'] for record in records],
+        'timestamp': [_timestamp(record['timestamp']) for record in records],
+        'prompt_tokens': [u.get('prompt_tokens') for u in usage],
+        'completion_tokens': [u.get('completion_tokens') for u in usage],
+        'cached_tokens': [(u.get('prompt_tokens_details') or {}).get('cached_tokens') for u in usage],
+    }
+    arrays = [pa.array(values, schema.field(name).type) for name, values in columns.items()]
+    # The ratings go in column by column, without a copy to Python objects
+    arrays += [pa.array(ratings[:, col]) for col in range(ratings.shape[1])]
+    return pa.Table.from_arrays(arrays, schema=schema)
+
+def store_output_file(file_path, root='results', modality='frame', batch=None, chunk_size=5000, parser=None):
+    """ Parse the records of an output file into the dataset under root; returns the number of rows.
+
+    batch is used for records without one (older outputs).
+    """
+    parser = parser or FeatureParser()
+    schema = results_schema(parser.features)
+    stem = os.path.splitext(os.path.basename(file_path))[0]
+    records = []
+    ratings = np.full((chunk_size, len(parser.features)), np.nan, dtype=np.float32)
+    chunk = 0
+    rows = 0
+
+    def write_chunk():
+        table = _chunk_table(records, ratings[:len(records)], modality, schema)
+        ds.write_dataset(table, root, format='parquet', partitioning=PARTITIONING,
+                         basename_template=f"{stem}-{chunk:05d}-{{i}}.parquet",
+                         existing_data_behavior='overwrite_or_ignore')
+
+    for record in iter_records(file_path):
+        content = response_content(record['response'])
+        if content is None:
+            continue
+        if record['batch'] is None:
+            record['batch'] = batch or 'unknown'
+        if record['id'] is None:
+            record['id'] = f"{stem}:{rows}"  # older outputs do not name the item
+        parser.parse_into(content, ratings[len(records)])
+        records.append(record)
+        rows += 1
+        if len(records) == chunk_size:
+            write_chunk()
+            records.clear()
+            ratings[:] = np.nan
+            chunk += 1
+    if records:
+        write_chunk()
+    return rows
+
+def results_dataset(root='results', features=FEATURES):
+    return ds.dataset(root, format='parquet', partitioning=PARTITIONING, schema=results_schema(features))
+
+def load_results(root='results', modality=None, batches=None, features=None, filter=None):
+    """ DataFrame of the stored ratings.
+
+    modality and batches select partitions, features selects rating columns
+    (all by default) and filter is an extra pyarrow.dataset expression,
+    e.g. ds.field('Dominant') > 50.
+    """
+    dataset = results_dataset(root)
+    condition = None
+    if modality is not None:
+        condition = ds.field('modality') == modality
+    if batches is not None:
+        in_batches = ds.field('batch').isin(list(batches))
+        condition = in_batches if condition is None else condition & in_batches
+    if filter is not None:
+        condition = filter if condition is None else condition & filter
+    info = ['id', 'modality', 'batch', 'model', 'timestamp', 'prompt_tokens', 'completion_tokens', 'cached_tokens']
+    columns = info + list(features if features is not None else FEATURES)
+    return dataset.to_table(columns=columns, filter=condition).to_pandas()
@@ -0,0 +1,123 @@
+# -*- coding: utf-8 -*-
+"""
+
+Resume index of the experiment scripts
+
+Tracks the state of every item (image file or video subfolder) in a small
+SQLite database next to the progress file:
+
+pending    not sent yet (or re-queued)
+in_flight  request sent, no result saved yet (e.g. the run crashed)
+done       response saved
+failed     no usable response, with the error message
+
+A restart skips done and failed items with a single set lookup each, and
+requeue_failed puts the failed items back to pending for another run.
+Several threads or processes can write to the same index.
+The progress file itself is still written, so older tools keep working;
+items listed in it are imported as done when an index is opened, and an
+item left in_flight although its progress line was written (a crash before
+the index was updated) is set to done as well.
+
+"""
+import os
+import sqlite3
+import threading
+import time
+
+PENDING = 'pending'
+IN_FLIGHT = 'in_flight'
+DONE = 'done'
+FAILED = 'failed'
+
+
+class ResumeIndex:
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("""CREATE TABLE IF NOT EXISTS items (
+                               id TEXT PRIMARY KEY,
+                               state TEXT NOT NULL,
+                               error TEXT,
+                               updated REAL NOT NULL)""")
+        self.db.commit()
+
+    @classmethod
+    def for_progress_file(cls, progress_file):
+        """ Open the index that belongs to a progress file, e.g. progress.txt -> progress_index.sqlite. """
+        index = cls(os.path.splitext(progress_file)[0] + '_index.sqlite')
+        index.import_progress_file(progress_file)
+        return index
+
+    def import_progress_file(self, progress_file):
+        """ Add the items of a progress file as done; in_flight items listed there are done too.
+
+        Failed and re-queued items are listed in the progress file as well
+        (their response was written), so they keep their state.
+        """
+        try:
+            with open(progress_file, 'r') as f:
+                ids = [line.strip() for line in f if line.strip()]
+        except FileNotFoundError:
+            return
+        now = time.time()
+        with self.lock:
+            self.db.executemany("INSERT INTO items VALUES (?, ?, NULL, ?) ON CONFLICT(id) DO UPDATE "
+                                "SET state = excluded.state, updated = excluded.updated WHERE state = ?",
+                                [(item_id, DONE, now, IN_FLIGHT) for item_id in ids])
+            self.db.commit()
+
+    def _set(self, item_id, state, error=None):
+        with self.lock:
+            self.db.execute("INSERT OR REPLACE INTO items VALUES (?, ?, ?, ?)",
+                            (item_id, state, error, time.time()))
+            self.db.commit()
+
+    def mark_in_flight(self, item_id):
+        self._set(item_id, IN_FLIGHT)
+
+    def mark_done(self, item_id):
+        self._set(item_id, DONE)
+
+    def mark_failed(self, item_id, error=''):
+        self._set(item_id, FAILED, str(error))
+
+    def state(self, item_id):
+        with self.lock:
+            row = self.db.execute("SELECT state FROM items WHERE id = ?", (item_id,)).fetchone()
+        return row[0] if row else PENDING
+
+    def ids(self, *states):
+        with self.lock:
+            rows = self.db.execute(f"SELECT id FROM items WHERE state IN ({','.join('?' * len(states))})",
+                                   states).fetchall()
+        return {row[0] for row in rows}
+
+    def completed(self):
+        """ Items a run should skip: done, and failed until they are re-queued. """
+        return self.ids(DONE, FAILED)
+
+    def failed(self):
+        """ (item id, error) of all failed items. """
+        with self.lock:
+            return self.db.execute("SELECT id, error FROM items WHERE state = ?", (FAILED,)).fetchall()
+
+    def requeue_failed(self):
+        """ Put the failed items back to pending; returns their ids. """
+        with self.lock:
+            ids = [row[0] for row in self.db.execute("SELECT id FROM items WHERE state = ?", (FAILED,))]
+            self.db.execute("UPDATE items SET state = ?, updated = ? WHERE state = ?",
+                            (PENDING, time.time(), FAILED))
+            self.db.commit()
+        return ids
+
+    def summary(self):
+        with self.lock:
+            return dict(self.db.execute("SELECT state, COUNT(*) FROM items GROUP BY state").fetchall())
+
+    def close(self):
+        with self.lock:
+            self.db.close()
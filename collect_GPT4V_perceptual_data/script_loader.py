@@ -0,0 +1,28 @@
+# -*- coding: utf-8 -*-
+"""
+
+Loading the experiment scripts without running them
+
+The experiment scripts are Spyder scripts that start their run at the
+bottom, and their names are not valid module names. The benchmarks load
+their functions with load_script: only imports, definitions and
+assignments of literals are executed, the run calls and the objects of the
+Parameters cell are left out.
+
+"""
+import ast
+import os
+
+def _script_tree(script_path):
+    with open(script_path, 'r', encoding='utf-8') as f:
+        return ast.parse(f.read())
+
+def load_script(script_path):
+    """ Namespace with the functions and constants of a script. """
+    tree = _script_tree(script_path)
+    keep = (ast.Import, ast.ImportFrom, ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)
+    body = [node for node in tree.body
+            if isinstance(node, keep) or (isinstance(node, ast.Assign) and isinstance(node.value, ast.Constant))]
+    namespace = {'__name__': os.path.basename(script_path)[:-3], '__file__': script_path}
+    exec(compile(ast.Module(body=body, type_ignores=[]), script_path, 'exec'), namespace)
+    return namespace
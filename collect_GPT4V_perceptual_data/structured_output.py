@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+"""
+
+Structured JSON answers instead of "Feature: score" lines
+
+With json_output the request carries a strict JSON schema (structured
+outputs) and the answer is one JSON object with an integer 0-100 for every
+one of the 138 features, keyed by the canonical feature name in the order of
+FEATURES:
+
+{"Dominant": 40, "Unpleasant": 10, ..., "Inequal": 0}
+
+FeatureParser decodes such answers straight into the ratings row, without
+the line regex; answers in the old text format, e.g. archived outputs, are
+still parsed line by line.
+
+Structured outputs need gpt-4o-2024-08-06 or later, so with_json_output
+also sets the model of the request.
+
+Ref: https://platform.openai.com/docs/guides/structured-outputs
+
+"""
+import copy
+
+from feature_schema import FEATURES
+from rating_prompts import FEATURE_LIST_HEADER, replace_prompt
+
+JSON_MODEL = 'gpt-4o-2024-08-06'
+
+JSON_INSTRUCTIONS = "Answer with a JSON object that gives the rating of every feature in the list below."
+
+def ratings_schema(features=FEATURES):
+    """ Schema of the ratings object: every feature required, as an integer. """
+    return {
+        "type": "object",
+        "properties": {feature: {"type": "integer"} for feature in features},
+        "required": list(features),
+        "additionalProperties": False,
+    }
+
+def ratings_format(features=FEATURES):
+    """ response_format of a request answered with the ratings object. """
+    return {"type": "json_schema",
+            "json_schema": {"name": "ratings", "strict": True, "schema": ratings_schema(features)}}
+
+def with_json_output(payload, model=JSON_MODEL):
+    """ A copy of a request body that asks for the ratings as a JSON object. """
+    payload = copy.copy(payload)
+    payload['model'] = model
+    payload['response_format'] = ratings_format()
+    payload['messages'] = copy.deepcopy(payload['messages'])
+
+    def ask_json(text):
+        # Before the feature list, so it follows the instructions for the text answer
+        head, sep, tail = text.partition(FEATURE_LIST_HEADER)
+        return head.rstrip('\n') + '\n' + JSON_INSTRUCTIONS + '\n\n' + sep + tail
+
+    replace_prompt(payload['messages'], ask_json)
+    return payload
+
+def is_json_answer(content):
+    # Refusals such as "{I'm sorry}" also start with a brace but are not JSON
+    return content.lstrip().startswith('{"')
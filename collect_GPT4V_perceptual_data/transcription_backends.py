@@ -0,0 +1,177 @@
+# -*- coding: utf-8 -*-
+"""
+
+Transcription backends for the audio2text script
+
+openai  Whisper API (whisper-1), paced by the RateLimitScheduler and retried
+        on 429/5xx and connection errors. Runs on threads.
+local   Whisper on the local CPU with faster-whisper (CTranslate2), offline.
+        Every worker process loads its own model, so the files are spread
+        over all cores.
+
+Both return the transcript text, which is saved next to the mp3 as the .txt
+file the video experiment reads, and Whisper's no_speech_prob (averaged over
+the segments, weighted by their duration) for the hallucination check.
+
+Ref: https://platform.openai.com/docs/guides/speech-to-text
+     https://github.com/SYSTRAN/faster-whisper
+
+"""
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+
+from audio_screening import has_speech
+from rate_limiter import RateLimitScheduler, is_retryable, retry_after
+
+
+def no_speech_score(segments):
+    # Duration weighted mean of the no_speech_prob of the segments
+    total = sum(end - start for start, end, _ in segments)
+    if not segments or total <= 0:
+        return None
+    return sum((end - start) * prob for start, end, prob in segments) / total
+
+
+class OpenAIWhisperBackend:
+
+    parallel = 'threads'
+
+    def __init__(self, scheduler=None, model='whisper-1', max_attempts=3):
+        # Pace the requests under the rate limits of the account
+        self.scheduler = scheduler or RateLimitScheduler()
+        self.model = model
+        self.max_attempts = max_attempts
+        self.client = None
+
+    def load(self):
+        if self.client is None:
+            from openai import OpenAI
+            # Retries are handled by the scheduler below
+            self.client = OpenAI(max_retries=0)
+
+    def transcribe(self, file_path):
+        import openai
+        self.load()
+        scheduler = self.scheduler
+        for attempt in range(self.max_attempts):
+            scheduler.acquire()
+            try:
+                with open(file_path, "rb") as audio_file:
+                    response = self.client.audio.transcriptions.with_raw_response.create(
+                        model=self.model,
+                        file=audio_file,
+                        response_format="verbose_json"
+                    )
+                scheduler.update_from_headers(response.headers.items())
+                result = json.loads(response.text)
+                segments = [(seg['start'], seg['end'], seg['no_speech_prob'])
+                            for seg in result.get('segments', [])]
+                return {'text': result['text'].strip() + '\n', 'no_speech_prob': no_speech_score(segments)}
+            except openai.APIStatusError as e:
+                scheduler.update_from_headers(e.response.headers.items())
+                if not is_retryable(e.status_code) or attempt == self.max_attempts - 1:
+                    raise
+                server_delay = retry_after(e.response.headers.items())
+                delay = scheduler.backoff(attempt, server_delay,
+                                          shared=e.status_code == 429 or server_delay is not None)
+            except openai.APIConnectionError:
+                if attempt == self.max_attempts - 1:
+                    raise
+                delay = scheduler.backoff(attempt, shared=False)
+            print(f"Error transcribing {file_path}, retrying in {delay:.1f} seconds.")
+            time.sleep(delay)
+
+
+class LocalWhisperBackend:
+
+    parallel = 'processes'
+
+    def __init__(self, model_size='small', compute_type='int8', cpu_threads=1, language=None, beam_size=5):
+        # One thread per worker process; the workers already use all the cores
+        self.model_size = model_size
+        self.compute_type = compute_type
+        self.cpu_threads = cpu_threads
+        self.language = language
+        self.beam_size = beam_size
+        self.model = None
+
+    def __getstate__(self):
+        # The model is loaded again in every worker process
+        state = self.__dict__.copy()
+        state['model'] = None
+        return state
+
+    def load(self):
+        if self.model is None:
+            from faster_whisper import WhisperModel
+            self.model = WhisperModel(self.model_size, device='cpu', compute_type=self.compute_type,
+                                      cpu_threads=self.cpu_threads)
+
+    def transcribe(self, file_path):
+        self.load()
+        segments, _ = self.model.transcribe(file_path, language=self.language, beam_size=self.beam_size)
+        segments = list(segments)
+        return {'text': ''.join(segment.text for segment in segments).strip() + '\n',
+                'no_speech_prob': no_speech_score([(seg.start, seg.end, seg.no_speech_prob) for seg in segments])}
+
+
+BACKENDS = {'openai': OpenAIWhisperBackend, 'local': LocalWhisperBackend}
+
+def make_backend(name='openai', **options):
+    """ Backend by its name in BACKENDS, e.g. make_backend('local', model_size='medium'). """
+    try:
+        return BACKENDS[name](**options)
+    except KeyError:
+        raise ValueError(f"Unknown transcription backend {name!r}, choose from {sorted(BACKENDS)}") from None
+
+
+def screen_and_transcribe(backend, file_path, min_speech_ratio=None):
+    """ Transcribe a file unless the voice activity check finds no speech in it.
+
+    Skipped files come back with text None and their speech_ratio.
+    """
+    if min_speech_ratio is not None:
+        speech, ratio = has_speech(file_path, min_speech_ratio)
+        if not speech:
+            return {'text': None, 'no_speech_prob': None, 'speech_ratio': ratio}
+    else:
+        ratio = None
+    result = backend.transcribe(file_path)
+    result['speech_ratio'] = ratio
+    return result
+
+_worker_backend = None
+
+def _init_worker(backend):
+    global _worker_backend
+    _worker_backend = backend
+    backend.load()
+
+def _transcribe_in_worker(file_path, min_speech_ratio):
+    return screen_and_transcribe(_worker_backend, file_path, min_speech_ratio)
+
+def transcribe_files(file_paths, backend, workers=None, min_speech_ratio=None):
+    """ Transcribe the files on a pool of workers; yields (file_path, result, error) as they finish.
+
+    result is the dict of screen_and_transcribe. A file that fails (after the
+    retries of the backend) is yielded with its error instead of stopping the run.
+    """
+    if backend.parallel == 'processes':
+        workers = workers or os.cpu_count()
+        executor = ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(backend,))
+        transcribe = _transcribe_in_worker
+    else:
+        workers = workers or 4
+        backend.load()
+        executor = ThreadPoolExecutor(max_workers=workers)
+        transcribe = lambda file_path, ratio: screen_and_transcribe(backend, file_path, ratio)
+
+    with executor:
+        futures = {executor.submit(transcribe, file_path, min_speech_ratio): file_path for file_path in file_paths}
+        for future in as_completed(futures):
+            try:
+                yield futures[future], future.result(), None
+            except Exception as e:
+                yield futures[future], None, e